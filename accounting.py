@@ -1,3 +1,5 @@
+from contextlib import closing
+import copy
 import datetime
 from decimal import Decimal
 from functools import reduce
@@ -5,14 +7,30 @@ import logging
 import json
 import os
 import pickle
-import traceback
 import sys
 
-from apis.coinbase import CoinbasePrimeApi
 from models import CURRENCIES, Transaction, Account, Currency
-from database import get_db_session
+from database import get_db_session, pool_stats
+from lot_index import LotAgingIndex, LotLifetimeIndex, HarvestIndex
+from lot_selection import make_lot_book
+from records import TransactionRecord
+from ledger_file import LedgerFile
+from pipeline import Pipeline
+from gains_aggregation import GainsColumns
+from sqlalchemy import select
 
 class OpenTransaction(object):
+	# Millions of these stay open at once, slots keep them small
+	__slots__ = (
+		'_transaction_id',
+		'_currency',
+		'_original_amount',
+		'_price',
+		'_fee',
+		'_transacted_at',
+		'_remaining_amount',
+	)
+
 	def __init__(self,
 		transaction_id,
 		currency,
@@ -28,6 +46,14 @@ class OpenTransaction(object):
 		self._transacted_at = transacted_at
 		self._remaining_amount = self._original_amount
 
+	def __getstate__(self):
+		return dict((slot, getattr(self, slot)) for slot in OpenTransaction.__slots__)
+
+	def __setstate__(self, state):
+		# Snapshots from before slots pickled the instance __dict__, same keys
+		for slot, value in state.items():
+			setattr(self, slot, value)
+
 	def __str__(self):
 		return self.__repr__()
 
@@ -44,6 +70,20 @@ class OpenTransaction(object):
 		return record
 
 class CapGainEvent(object):
+	__slots__ = (
+		'_buy_txn_id',
+		'_sell_txn_id',
+		'_currency',
+		'_qty',
+		'_cost_basis',
+		'_purchased_at',
+		'_proceeds',
+		'_sold_at',
+		'_gain',
+		'_is_short_term',
+		'_account',
+	)
+
 	def __init__(self,
 		buy_txn_id,
 		sell_txn_id,
@@ -54,7 +94,8 @@ class CapGainEvent(object):
 		proceeds,
 		sold_at,
 		gain,
-		is_short_term = True):
+		is_short_term = True,
+		account = None):
 		self._buy_txn_id = buy_txn_id
 		self._sell_txn_id = sell_txn_id
 		self._currency = currency
@@ -65,6 +106,16 @@ class CapGainEvent(object):
 		self._sold_at = sold_at
 		self._gain = gain
 		self._is_short_term = is_short_term
+		self._account = account # Account the sell came from
+
+	def __getstate__(self):
+		return dict((slot, getattr(self, slot)) for slot in CapGainEvent.__slots__)
+
+	def __setstate__(self, state):
+		if '_account' not in state:
+			state = dict(state, _account=None)
+		for slot, value in state.items():
+			setattr(self, slot, value)
 
 	def __str__(self):
 		return self.__repr__()
@@ -83,14 +134,38 @@ class CapGainEvent(object):
 		return record
 
 class VirtualWallet(object):
-	def __init__(self, currency, time):
+	def __init__(self, currency, time, observers=None, lot_method='fifo', lot_options=None):
 		self._currency = currency
 		self._time = time
-		self._open_txns = list()
+		self._lot_method = lot_method
+		self._open_txns = make_lot_book(lot_method, **(lot_options or dict()))
+		# Shared with the portfolio, notified as lots are opened and relieved
+		self._observers = observers if observers is not None else list()
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state.pop('_observers', None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._observers = list()
+		# Snapshots from before lot selection methods kept a plain FIFO list
+		if isinstance(self._open_txns, list):
+			self._lot_method = 'fifo'
+			self._open_txns = make_lot_book('fifo', self._open_txns)
+
+	def set_lot_method(self, lot_method, lot_options=None):
+		if lot_method == self._lot_method:
+			return
+		# Books store lots in the old method's order, new ones are filled in acquisition order
+		lots = sorted(self._open_txns.unordered(), key=lambda lot: (lot._transacted_at, lot._transaction_id))
+		self._lot_method = lot_method
+		self._open_txns = make_lot_book(lot_method, lots, **(lot_options or dict()))
 
 	def process(self, transaction):
 		if transaction.to_currency == transaction.from_currency and (transaction.to_account != Account.External and transaction.from_account != Account.External):
-			print(transaction)
+			logging.getLogger('VirtualWallet').error('Same currency transaction %s' %(str(transaction)))
 			raise Exception('Transactions with the same to/from currency do not incur cap gains')
 		cap_gain_events = list()
 		is_bought = (transaction.from_account == transaction.to_account and transaction.to_currency == self._currency) \
@@ -102,26 +177,34 @@ class VirtualWallet(object):
 			transaction_price = Decimal(transaction.usd_value) / Decimal(transaction.to_amount)
 			transaction_fee = Decimal(transaction.fee) / Decimal(transaction.to_amount)
 			# Add to open transactions
-			self._open_txns.append(
-				OpenTransaction(
-					transaction.id,
-					self._currency,
-					transaction.to_amount,
-					transaction_price, # per coin
-					transaction_fee, # per coin
-					transaction.transacted_at))
+			open_txn = OpenTransaction(
+				transaction.id,
+				self._currency,
+				transaction.to_amount,
+				transaction_price, # per coin
+				transaction_fee, # per coin
+				transaction.transacted_at)
+			self._open_txns.append(open_txn)
+			for observer in self._observers:
+				observer.lot_opened(open_txn)
 
 		elif is_sold:
-			# Match open transactions from earliest first
+			# Match open transactions in the order of the lot selection method
 			txn_qty = Decimal(transaction.from_amount)
 			txn_price = Decimal(transaction.usd_value) / txn_qty
 			txn_fee = Decimal(transaction.fee) / txn_qty
-			remove_up_to = 0
-			for index, open_txn in enumerate(self._open_txns):
+			while txn_qty > 0.0:
+				open_txn = self._open_txns.head()
+				if open_txn is None:
+					break
+				lot_price, lot_fee = self._open_txns.unit_cost(open_txn)
 				match_amount = min(open_txn._remaining_amount, txn_qty)
 				txn_qty -= match_amount
-				open_txn._remaining_amount -= match_amount
-				gain = match_amount * (txn_price - open_txn._price - txn_fee - open_txn._fee)
+				# Removes the lot from the book once it has 0 remaining amount
+				self._open_txns.relieve(open_txn, match_amount)
+				for observer in self._observers:
+					observer.lot_relieved(open_txn, match_amount, transaction.transacted_at)
+				gain = match_amount * (txn_price - lot_price - txn_fee - lot_fee)
 				is_short_term = transaction.transacted_at - open_txn._transacted_at < datetime.timedelta(days=365)
 				cap_gain_events.append(
 					CapGainEvent(
@@ -129,18 +212,13 @@ class VirtualWallet(object):
 						transaction.id,
 						self._currency,
 						match_amount, # qty
-						match_amount * (open_txn._price + txn_fee + open_txn._fee), # cost_basis
+						match_amount * (lot_price + txn_fee + lot_fee), # cost_basis
 						open_txn._transacted_at,
 						match_amount * txn_price, # proceeds
 						transaction.transacted_at,
 						gain,
-						is_short_term))
-				if open_txn._remaining_amount == 0.0:
-					remove_up_to = index + 1
-				if txn_qty == 0.0:
-					break
-			# Remove open transactions with 0 remaining amount
-			self._open_txns = self._open_txns[remove_up_to:]
+						is_short_term,
+						transaction.from_account))
 			if txn_qty != 0.0:
 				raise Exception('Insufficient open transactions to match, transaction_id=%d' %(transaction.id))
 
@@ -149,11 +227,7 @@ class VirtualWallet(object):
 		return cap_gain_events
 
 	def metrics(self):
-		outstanding_qty = Decimal(0.0)
-		total_cost = Decimal(0.0)
-		for open_txn in self._open_txns:
-			outstanding_qty += open_txn._remaining_amount
-			total_cost += open_txn._remaining_amount * open_txn._price
+		outstanding_qty, total_cost = self._open_txns.cost_totals()
 		if outstanding_qty > 0.0:
 			avg_cost = total_cost / outstanding_qty
 		else:
@@ -163,7 +237,9 @@ class VirtualWallet(object):
 	def report(self, mark_time):
 		outstanding_qty, avg_cost = self.metrics()
 		if outstanding_qty > 0.0:
-			price = CoinbasePrimeApi.get_usd_price(CURRENCIES[self._currency.value], mark_time)
+			# Imported here so runs that never mark to market skip the api stack
+			from apis.coinbase import get_api
+			price = get_api('CoinbasePrime').get_usd_price(CURRENCIES[self._currency.value], mark_time)
 			return {
 				'last_transacted_time': self._time.isoformat(),
 				'mark_time': mark_time.isoformat(),
@@ -182,12 +258,144 @@ class VirtualWallet(object):
 				'unrealized_gains': Decimal(0.0)
 			}
 
+class SnapshotUnpickler(pickle.Unpickler):
+	# Snapshots saved by running this file as a script refer to __main__
+	def find_class(self, module, name):
+		if module == '__main__':
+			module = 'accounting'
+		return super(SnapshotUnpickler, self).find_class(module, name)
+
 class Portfolio(object):
 	DATETIME_FORMAT = '%Y%m%d.%H%M%S%f'
-	def __init__(self, name, time):
+	def __init__(self, name, time, lot_method='fifo'):
 		self._name = name
 		self._time = time
+		self._lot_method = lot_method
 		self._wallets = dict()
+		self._lot_observers = list()
+		self._lot_aging_index = None
+		self._harvest_index = None
+
+	def __getstate__(self):
+		# Indexes are rebuilt on demand, never pickled with the snapshot
+		state = self.__dict__.copy()
+		state.pop('_lot_observers', None)
+		state.pop('_lot_aging_index', None)
+		state.pop('_harvest_index', None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		if '_lot_method' not in state:
+			self._lot_method = 'fifo'
+		self._lot_observers = list()
+		self._lot_aging_index = None
+		self._harvest_index = None
+		for wallet in self._wallets.values():
+			wallet._observers = self._lot_observers
+
+	def lot_options(self, currency):
+		if self._lot_method == 'fifo_spill':
+			# Spilled lots live next to the snapshots that reference them
+			return {
+				'spill_path': os.path.join('data', self._name, 'lots', '%s.lots' %(CURRENCIES[currency.value]))
+			}
+		return dict()
+
+	def set_lot_method(self, lot_method):
+		self._lot_method = lot_method
+		for currency, wallet in self._wallets.items():
+			wallet.set_lot_method(lot_method, self.lot_options(currency))
+
+	def add_lot_observer(self, observer):
+		for wallet in self._wallets.values():
+			for open_txn in wallet._open_txns.unordered():
+				observer.lot_opened(open_txn)
+		self._lot_observers.append(observer)
+
+	def lot_aging_index(self):
+		if self._lot_aging_index is None:
+			self._lot_aging_index = LotAgingIndex()
+			self._lot_aging_index.load_lots(
+				open_txn for wallet in self._wallets.values() for open_txn in wallet._open_txns.unordered())
+			self._lot_observers.append(self._lot_aging_index)
+		return self._lot_aging_index
+
+	def lots_turning_long_term(self, days, as_of=None):
+		if as_of is None:
+			as_of = self._time
+		return self.lot_aging_index().crossing_long_term(as_of, days)
+
+	def harvest_index(self):
+		if self._harvest_index is None:
+			self._harvest_index = HarvestIndex(self._time)
+			self._harvest_index.load_lots(
+				open_txn for wallet in self._wallets.values() for open_txn in wallet._open_txns.unordered())
+			self._lot_observers.append(self._harvest_index)
+		return self._harvest_index
+
+	def plan_harvest(self, prices, target_loss, as_of=None):
+		# Picks open lots priced above prices[currency] until their losses
+		# reach target_loss, short term lots first and within a term the lots
+		# losing the largest fraction of their cost basis, selling only part
+		# of the last one. Which lots a sale of those quantities actually
+		# relieves is up to the lot method, so the realized gains are
+		# projected from the lot books.
+		if as_of is None:
+			as_of = self._time
+		index = self.harvest_index()
+		remaining_loss = Decimal(target_loss)
+		candidates = list()
+		sales = dict()
+		for ratio, seq, key in index.candidates(prices, as_of):
+			if remaining_loss <= 0:
+				break
+			currency, transaction_id = key
+			acquired_at, lot_qty, unit_cost, lot_seq, is_long_term = index.lot(key)
+			loss_per_coin = unit_cost - prices[currency]
+			qty = min(lot_qty, remaining_loss / loss_per_coin)
+			remaining_loss -= qty * loss_per_coin
+			sales[currency] = sales.get(currency, Decimal(0.0)) + qty
+			candidates.append({
+				'currency': currency,
+				'transaction_id': transaction_id,
+				'acquired_at': acquired_at,
+				'is_short_term': not is_long_term,
+				'qty': qty,
+				'unit_cost': unit_cost,
+				'loss': qty * loss_per_coin,
+				'loss_ratio': -ratio
+			})
+		projected = dict()
+		for currency, qty in sales.items():
+			projection = {
+				'qty': qty,
+				'proceeds': qty * prices[currency],
+				'cost_basis': Decimal(0.0),
+				'short_term_gain': Decimal(0.0),
+				'long_term_gain': Decimal(0.0),
+				'num_lots': 0
+			}
+			for lot, match_amount, lot_price, lot_fee in self._wallets[currency]._open_txns.preview(qty):
+				cost_basis = match_amount * (lot_price + lot_fee)
+				gain = match_amount * prices[currency] - cost_basis
+				projection['cost_basis'] += cost_basis
+				if as_of - lot._transacted_at < datetime.timedelta(days=365):
+					projection['short_term_gain'] += gain
+				else:
+					projection['long_term_gain'] += gain
+				projection['num_lots'] += 1
+			projection['gain'] = projection['short_term_gain'] + projection['long_term_gain']
+			projected[currency] = projection
+		return {
+			'as_of': as_of.isoformat(),
+			'lot_method': self._lot_method,
+			'target_loss': Decimal(target_loss),
+			'candidate_loss': Decimal(target_loss) - max(remaining_loss, Decimal(0.0)),
+			'candidates': candidates,
+			'projected': projected,
+			'projected_gain': sum((projection['gain'] for projection in projected.values()), Decimal(0.0))
+		}
 
 	@staticmethod
 	def time2str(time):
@@ -197,36 +405,59 @@ class Portfolio(object):
 	def file2time(filepath):
 		filename = os.path.basename(filepath)
 		string = filename[10:-4] # pulls part in "portfolio.(?).pkl"
-		return datetime.strptime(string, Portfolio.DATETIME_FORMAT)
+		return datetime.datetime.strptime(string, Portfolio.DATETIME_FORMAT)
 
 	@staticmethod
 	def time2file(time):
 		return os.path.join('portfolio.%s.pkl' %(Portfolio.time2str(time)))
 
+	@staticmethod
+	def checkpoint_path(name, time, kind='portfolio'):
+		# Indexes built alongside a snapshot are saved next to it
+		return os.path.join('data', name, '%s.%s.pkl' %(kind, Portfolio.time2str(time)))
+
+	@staticmethod
+	def checkpoint_times(name):
+		account_dir = os.path.join('data', name)
+		if not os.path.isdir(account_dir):
+			return list()
+		return sorted(
+			Portfolio.file2time(filename)
+			for filename in os.listdir(account_dir)
+			if filename.startswith('portfolio.') and filename.endswith('.pkl'))
+
 	@staticmethod
 	def load(name, time):
 		filepath = os.path.join('data', name, Portfolio.time2file(time))
 		if not os.path.exists(filepath):
 			raise Exception('No portfolio file exists at "%s"' %(filepath))
 		with open(filepath, 'rb') as pickle_file:
-			data = pickle.load(pickle_file, encoding='latin1')
+			data = SnapshotUnpickler(pickle_file, encoding='latin1').load()
 		return data
 
 	def save(self):
-		filepath = os.path.join(account_dir, Portfolio.time2file(self._time))
+		filepath = os.path.join('data', self._name, Portfolio.time2file(self._time))
 		with open(filepath, 'wb') as pickle_file:
 			pickle.dump(self, pickle_file)
 
-	def process(self, transaction):
+	def process(self, transaction, only_currencies=None):
 		# Determine the relevant currencies (excludes USD)
 		relevant_currencies = [transaction.to_currency, transaction.from_currency]
 		relevant_currencies = filter(lambda x: x != Currency.USD, relevant_currencies)
 		relevant_currencies = set(relevant_currencies)
+		if only_currencies is not None:
+			# Wallets are independent, so a subset can be replayed on its own
+			relevant_currencies &= only_currencies
 		cap_gain_events = list()
 		for currency in relevant_currencies:
 			# Create virtual wallet if it doesn't exist yet
 			if currency not in self._wallets:
-				self._wallets[currency] = VirtualWallet(currency, transaction.transacted_at)
+				self._wallets[currency] = VirtualWallet(
+					currency,
+					transaction.transacted_at,
+					self._lot_observers,
+					self._lot_method,
+					self.lot_options(currency))
 			# Process the transaction
 			cap_gain_events += self._wallets[currency].process(transaction)
 		self._time = transaction.transacted_at
@@ -247,38 +478,6 @@ class Portfolio(object):
 		}
 		return report
 
-class CapGainsAggregator(object):
-	class TermAggr(object):
-		def __init__(self):
-			self._gain = Decimal(0.0)
-			self._purchased_range = [datetime.datetime(1970,1,1), datetime.datetime(1970,1,1)]
-			self._sold_range = [datetime.datetime(1970,1,1), datetime.datetime(1970,1,1)]
-			self._total_qty = Decimal(0.0)
-			self._total_cost_basis = Decimal(0.0)
-			self._total_proceeds = Decimal(0.0)
-
-		def add_event(self, event):
-			self._gain += event._gain
-			self._total_qty += event._qty
-			self._total_cost_basis += event._cost_basis
-			self._total_proceeds += event._proceeds
-			self._purchased_range = [
-				min(self._purchased_range[0], event._purchased_at),
-				max(self._purchased_range[1], event._purchased_at)]
-			self._sold_range = [
-				min(self._sold_range[0], event._sold_at),
-				max(self._sold_range[1], event._sold_at)]
-
-	def __init__(self):
-		self._short = CapGainsAggregator.TermAggr()
-		self._long = CapGainsAggregator.TermAggr()
-
-	def add_event(self, event):
-		if event._is_short_term:
-			self._short.add_event(event)
-		else: # long term
-			self._long.add_event(event)
-
 class CapFifoQueue(object):
 	def __init__(self,
 		portfolio,
@@ -287,7 +486,7 @@ class CapFifoQueue(object):
 		self._portfolio = portfolio
 		self._start_time = portfolio._time
 		self._end_time = end_time
-		self._cap_gains_aggrs = dict()
+		self._gains = GainsColumns()
 		self._num_txns_processed = 0
 		self._time = self._start_time
 
@@ -297,90 +496,202 @@ class CapFifoQueue(object):
 			return
 		cap_gain_events = self._portfolio.process(transaction)
 		self._time = transaction.transacted_at
-		for cap_gain_event in cap_gain_events:
-			if cap_gain_event._currency not in self._cap_gains_aggrs:
-				self._cap_gains_aggrs[cap_gain_event._currency] = CapGainsAggregator()
-			self._cap_gains_aggrs[cap_gain_event._currency].add_event(cap_gain_event)
-
-	def get_transactions(self):
-		if self._portfolio._name == 'business':
-			transactions = self._db_session.query(Transaction)\
-				.filter(Transaction.from_account == Account.CoinbasePrime)\
-				.filter(Transaction.to_account == Account.CoinbasePrime)\
-				.filter(Transaction.transacted_at >= self._start_time)\
-				.filter(Transaction.transacted_at < self._end_time)\
-				.order_by(Transaction.transacted_at.asc())
-			self._log.info('Found %d transactions' %(transactions.count()))
-		elif self._portfolio._name == 'personal':
-			transactions = self._db_session.query(Transaction)\
-				.filter(Transaction.from_account != Account.CoinbasePrime)\
-				.filter(Transaction.to_account != Account.CoinbasePrime)\
-				.filter(Transaction.transacted_at >= self._start_time)\
-				.filter(Transaction.transacted_at < self._end_time)\
-				.order_by(Transaction.transacted_at.asc())
-			self._log.info('Found %d transactions' %(transactions.count()))
+		self._gains.add_events(cap_gain_events)
+
+	@staticmethod
+	def portfolio_filters(name):
+		if name == 'business':
+			return [
+				Transaction.from_account == Account.CoinbasePrime,
+				Transaction.to_account == Account.CoinbasePrime]
+		elif name == 'personal':
+			return [
+				Transaction.from_account != Account.CoinbasePrime,
+				Transaction.to_account != Account.CoinbasePrime]
 		else:
-			raise Exception('Unrecognized portfolio name "%s"' %(self._portfolio._name))
-		return transactions
+			raise Exception('Unrecognized portfolio name "%s"' %(name))
+
+	def transaction_filters(self):
+		return CapFifoQueue.portfolio_filters(self._portfolio._name) + [
+			Transaction.transacted_at >= self._start_time,
+			Transaction.transacted_at < self._end_time]
+
+	def fetch_batches(self, batch_size):
+		# Uses its own session, so it can also run in the pipeline's fetch
+		# thread. Selects plain columns through a server side cursor instead
+		# of hydrating ORM objects.
+		db_session = get_db_session()
+		try:
+			statement = select(*[getattr(Transaction, field) for field in TransactionRecord._fields])\
+				.where(*self.transaction_filters())\
+				.order_by(Transaction.transacted_at.asc())
+			result = db_session.execute(
+				statement,
+				execution_options = {'stream_results': True})
+			for rows in result.partitions(batch_size):
+				yield rows
+		finally:
+			db_session.close()
 
-	def process_transactions(self):
+	@staticmethod
+	def decode_batch(rows):
+		return [TransactionRecord._make(row) for row in rows]
+
+	def records(self, batch_size=1000):
+		# Rows become TransactionRecords once, here, and the engine never
+		# sees an ORM instance
+		for rows in self.fetch_batches(batch_size):
+			for record in CapFifoQueue.decode_batch(rows):
+				yield record
+
+	def stream_records(self, batch_size=1000, maxsize=8):
+		return Pipeline(
+			source = lambda: self.fetch_batches(batch_size),
+			stages = [CapFifoQueue.decode_batch],
+			maxsize = maxsize)
+
+	def process_ledger_file(self, ledger):
+		# Replays an exported ledger file instead of querying the database
+		ledger.check(self._portfolio._name, self._start_time, self._end_time)
+		self._log.info('process_ledger_file')
+		with closing(ledger.records(self._start_time, self._end_time)) as records:
+			for record in records:
+				self.process(record)
+				self._num_txns_processed += 1
+		self._portfolio._time = self._end_time
+
+	def process_transactions(self, pipelined=False):
 		self._log.info('process_transactions')
 		self._log.info('start_time = %s', self._start_time.isoformat())
 		self._log.info('end_time = %s', self._end_time.isoformat())
-		self._db_session = get_db_session()
+		if pipelined:
+			# Fetching and decoding overlap with matching in this thread
+			with closing(iter(self.stream_records())) as records:
+				for record in records:
+					self.process(record)
+					self._num_txns_processed += 1
+			self._portfolio._time = self._end_time
+			return
 		try:
-			transactions = self.get_transactions()
-			for transaction in transactions:
-				self.process(transaction)
-				self._num_txns_processed += 1
+			with closing(self.records()) as records:
+				for record in records:
+					self.process(record)
+					self._num_txns_processed += 1
 			self._portfolio._time = self._end_time
 		except Exception as e:
-			print(traceback.format_exc())
+			self._log.exception('process_transactions failed')
 			raise e
-		finally:
-			self._db_session.close()
+
+class TaxSimulation(object):
+	# Feeds one scan of the ledger to a copy of the portfolio per lot method
+	def __init__(self,
+		portfolio,
+		lot_methods,
+		end_time = None):
+		self._log = logging.getLogger('TaxSimulation')
+		if 'fifo_spill' in lot_methods:
+			# Spilled books append to the saved spill files, and match as fifo does
+			raise Exception('Simulate fifo rather than fifo_spill, it would write to the saved spill files')
+		self._queues = dict()
+		for lot_method in lot_methods:
+			method_portfolio = copy.deepcopy(portfolio)
+			if lot_method != method_portfolio._lot_method:
+				method_portfolio.set_lot_method(lot_method)
+			self._queues[lot_method] = CapFifoQueue(
+				portfolio = method_portfolio,
+				end_time = end_time)
+
+	def process_transactions(self, pipelined=False, ledger=None):
+		queues = list(self._queues.values())
+		source = queues[0]
+		self._log.info('Simulating lot methods %s' %(', '.join(self._queues.keys())))
+		if ledger is not None:
+			# Replays an exported ledger file instead of querying the database
+			ledger.check(source._portfolio._name, source._start_time, source._end_time)
+			with closing(ledger.records(source._start_time, source._end_time)) as records:
+				for record in records:
+					for queue in queues:
+						queue.process(record)
+						queue._num_txns_processed += 1
+			for queue in queues:
+				queue._portfolio._time = queue._end_time
+			return
+		if pipelined:
+			with closing(iter(source.stream_records())) as records:
+				for record in records:
+					for queue in queues:
+						queue.process(record)
+						queue._num_txns_processed += 1
+			for queue in queues:
+				queue._portfolio._time = queue._end_time
+			return
+		# Decoded once, every portfolio reads the same record
+		with closing(source.records()) as records:
+			for record in records:
+				for queue in queues:
+					queue.process(record)
+					queue._num_txns_processed += 1
+		for queue in queues:
+			queue._portfolio._time = queue._end_time
 
 class CapGains(object):
 
 	@staticmethod
-	def report(name, start_time, end_time):
+	def term_summary(gains, term):
+		# Every currency with events is listed for both terms, zeros included
+		by_currency = dict(
+			(row['currency'], row) for row in gains.group_by(['term', 'currency']) if row['term'] == term)
+		details = list()
+		for row in gains.group_by(['currency']):
+			term_row = by_currency.get(row['currency'], dict())
+			details.append({
+				'currency': CURRENCIES[row['currency'].value],
+				'total_qty': term_row.get('qty', Decimal(0.0)),
+				'total_cost_basis': term_row.get('cost_basis', Decimal(0.0)),
+				'total_proceeds': term_row.get('proceeds', Decimal(0.0)),
+				'gain': term_row.get('gain', Decimal(0.0))
+			})
+		totals = gains.group_by(['term'])
+		term_total = next((row for row in totals if row['term'] == term), dict())
+		return {
+			'gain': term_total.get('gain', Decimal(0.0)),
+			'total_proceeds': term_total.get('proceeds', Decimal(0.0)),
+			'total_cost_basis': term_total.get('cost_basis', Decimal(0.0)),
+			'details': details
+		}
+
+	@staticmethod
+	def lifetime_index(portfolio):
+		# Continue the index saved with the starting snapshot if there is one
+		filepath = Portfolio.checkpoint_path(portfolio._name, portfolio._time, 'lifetimes')
+		if os.path.exists(filepath):
+			index = LotLifetimeIndex.load(filepath)
+		else:
+			index = LotLifetimeIndex(valid_from = portfolio._time)
+		portfolio.add_lot_observer(index)
+		return index
+
+	@staticmethod
+	def report(name, start_time, end_time, aging_days=None, track_lifetimes=False, lot_method=None, pipelined=False, breakdowns=(), ledger_file=None):
 		start_portfolio = Portfolio.load(name, start_time)
+		if lot_method is not None and lot_method != start_portfolio._lot_method:
+			start_portfolio.set_lot_method(lot_method)
+		if track_lifetimes:
+			lifetime_index = CapGains.lifetime_index(start_portfolio)
 		fifo_queue = CapFifoQueue(
 			portfolio = start_portfolio,
 			end_time = end_time)
-		fifo_queue.process_transactions()
+		if ledger_file is not None:
+			with LedgerFile(ledger_file) as ledger:
+				fifo_queue.process_ledger_file(ledger)
+		else:
+			fifo_queue.process_transactions(pipelined)
 		fifo_queue._portfolio.save()
-		short_details = [
-			{
-				'currency': CURRENCIES[key.value],
-				'total_qty': aggr._short._total_qty,
-				'total_cost_basis': aggr._short._total_cost_basis,
-				'total_proceeds': aggr._short._total_proceeds,
-				'gain': aggr._short._gain
-			}
-		for key, aggr in fifo_queue._cap_gains_aggrs.items()]
-		short = {
-			'gain': reduce(lambda x, y: x + y['gain'], short_details, Decimal(0.0)),
-			'total_proceeds': reduce(lambda x, y: x + y['total_proceeds'], short_details, Decimal(0.0)),
-			'total_cost_basis': reduce(lambda x, y: x + y['total_cost_basis'], short_details, Decimal(0.0)),
-			'details': short_details
-		}
-		long_details = [
-			{
-				'currency': CURRENCIES[key.value],
-				'total_qty': aggr._long._total_qty,
-				'total_cost_basis': aggr._long._total_cost_basis,
-				'total_proceeds': aggr._long._total_proceeds,
-				'gain': aggr._long._gain
-			}
-		for key, aggr in fifo_queue._cap_gains_aggrs.items()]
-		long = {
-			'gain': reduce(lambda x, y: x + y['gain'], long_details, Decimal(0.0)),
-			'total_proceeds': reduce(lambda x, y: x + y['total_proceeds'], long_details, Decimal(0.0)),
-			'total_cost_basis': reduce(lambda x, y: x + y['total_cost_basis'], long_details, Decimal(0.0)),
-			'details': long_details
-		}
-		return {
+		if track_lifetimes:
+			lifetime_index.save(Portfolio.checkpoint_path(name, fifo_queue._portfolio._time, 'lifetimes'))
+		short = CapGains.term_summary(fifo_queue._gains, 'short')
+		long = CapGains.term_summary(fifo_queue._gains, 'long')
+		report = {
 			'start_time': start_time.isoformat(),
 			'end_time': end_time.isoformat(),
 			'short_term': short,
@@ -388,6 +699,59 @@ class CapGains(object):
 			'unrealized_gains': fifo_queue._portfolio.mark(),
 			'num_txns_processed': fifo_queue._num_txns_processed
 		}
+		if len(breakdowns) > 0:
+			report['breakdowns'] = dict(
+				(','.join(dimensions), fifo_queue._gains.group_by(dimensions))
+			for dimensions in breakdowns)
+		if aging_days is not None:
+			report['lots_turning_long_term'] = [
+				dict(lot,
+					acquired_at = lot['acquired_at'].isoformat(),
+					long_term_at = lot['long_term_at'].isoformat())
+			for lot in fifo_queue._portfolio.lots_turning_long_term(aging_days)]
+		return report
+
+	@staticmethod
+	def simulate(name, start_time, end_time, lot_methods, pipelined=False, ledger_file=None):
+		start_portfolio = Portfolio.load(name, start_time)
+		simulation = TaxSimulation(
+			portfolio = start_portfolio,
+			lot_methods = lot_methods,
+			end_time = end_time)
+		if ledger_file is not None:
+			with LedgerFile(ledger_file) as ledger:
+				simulation.process_transactions(ledger=ledger)
+		else:
+			simulation.process_transactions(pipelined)
+		methods = dict()
+		for lot_method, queue in simulation._queues.items():
+			short = CapGains.term_summary(queue._gains, 'short')
+			long = CapGains.term_summary(queue._gains, 'long')
+			remaining_cost_basis = Decimal(0.0)
+			for wallet in queue._portfolio._wallets.values():
+				outstanding_qty, total_cost = wallet._open_txns.cost_totals()
+				remaining_cost_basis += total_cost
+			methods[lot_method] = {
+				'short_term_gain': short['gain'],
+				'long_term_gain': long['gain'],
+				'total_gain': short['gain'] + long['gain'],
+				'total_proceeds': short['total_proceeds'] + long['total_proceeds'],
+				'remaining_cost_basis': remaining_cost_basis,
+				'num_txns_processed': queue._num_txns_processed
+			}
+		return {
+			'start_time': start_time.isoformat(),
+			'end_time': end_time.isoformat(),
+			'methods': methods
+		}
+
+	@staticmethod
+	def format_simulation(simulation):
+		columns = ('short_term_gain', 'long_term_gain', 'total_gain', 'remaining_cost_basis')
+		lines = ['%-10s' %('method') + ''.join('%22s' %(column) for column in columns)]
+		for lot_method, result in simulation['methods'].items():
+			lines.append('%-10s' %(lot_method) + ''.join('%22.2f' %(result[column]) for column in columns))
+		return '\n'.join(lines)
 
 if __name__ == '__main__':
 
@@ -398,6 +762,14 @@ if __name__ == '__main__':
 	parser.add_option('-L', '--log-level',
 		default = 'INFO',
 		help = 'log level {DEBUG, INFO, WARNING, ERROR, CRITICAL}. [%default]')
+	parser.add_option('-J', '--log-json',
+		action='store_true',
+		default=False,
+		help='Log JSON Lines instead of text')
+	parser.add_option('-Q', '--log-queue',
+		action='store_true',
+		default=False,
+		help='Hand log records to a background thread so callers never wait on log I/O')
 	parser.add_option('-t', '--type',
 		type=str,
 		help='Name of the account type {business, personal}')
@@ -407,31 +779,66 @@ if __name__ == '__main__':
 	parser.add_option('-e', '--end-time',
 		type=str,
 		help='String of datetime to end {2019-01-19T13:59:12.562Z}')
+	parser.add_option('-g', '--aging-days',
+		type=int,
+		help='Also list open lots turning long term within this many days of end time')
+	parser.add_option('-l', '--lifetimes',
+		action='store_true',
+		default=False,
+		help='Save a lot lifetime index next to the end time portfolio snapshot')
+	parser.add_option('-m', '--lot-method',
+		type=str,
+		help='Lot selection method {fifo, lifo, hifo, average, fifo_spill}, defaults to that of the start portfolio')
+	parser.add_option('--simulate',
+		type=str,
+		help='Comma separated lot methods to compare in one pass instead of reporting {fifo,lifo,hifo,average}')
+	parser.add_option('-b', '--breakdown',
+		type=str,
+		action='append',
+		default=[],
+		help='Comma separated dimensions to also group gains by, repeatable {currency, term, month, year, account, holding_period}')
+	parser.add_option('-P', '--pipelined',
+		action='store_true',
+		default=False,
+		help='Overlap database fetch and decoding with lot matching')
+	parser.add_option('-H', '--harvest',
+		type=float,
+		help='Plan realizing this much loss from the end time snapshot instead of reporting')
+	parser.add_option('-p', '--price',
+		type=str,
+		action='append',
+		default=[],
+		help='CURRENCY=PRICE to plan the harvest at, repeatable, other wallets are priced at end time')
+	parser.add_option('-V', '--validate',
+		action='store_true',
+		default=False,
+		help='Check the whole range for rows lot matching would fail on first, and stop listing them if any')
+	parser.add_option('-f', '--ledger-file',
+		type=str,
+		help='Read transactions from a file written by ledger_file.py instead of the database')
 	(opts, args) = parser.parse_args()
 
 	import logging
 	import os
 	from util import log_setup
-	log_setup.setupLogging(opts.log_level)
+	log_setup.setupLogging(opts.log_level, json_lines=opts.log_json, queued=opts.log_queue)
 	log = logging.getLogger('main')
 
+	# Use the importable classes so saved snapshots load from other tools
+	from accounting import Portfolio, CapGains
+
 	DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
 	account_dir = os.path.join('data', opts.type)
 	if not os.path.isdir(account_dir):
 		os.mkdir(account_dir)
 		# Create starting portfolio
-		portfolio = Portfolio(opts.type, datetime.datetime(2010,1,1,0,0,0))
+		portfolio = Portfolio(opts.type, datetime.datetime(2010,1,1,0,0,0), opts.lot_method or 'fifo')
 		portfolio.save()
 
-	start_time = datetime.datetime.strptime(opts.start_time, DATETIME_FORMAT)
+	start_time = datetime.datetime.strptime(opts.start_time, DATETIME_FORMAT) if opts.start_time else None
 	end_time = datetime.datetime.strptime(opts.end_time, DATETIME_FORMAT)
 
-	# Run cap gains report
-	report = CapGains.report(
-		name = opts.type,
-		start_time = start_time,
-		end_time = end_time)
 	printable_report = dict()
 	def make_printable(d):
 		new_dict = dict()
@@ -449,15 +856,82 @@ if __name__ == '__main__':
 				new_dict[k] = float(v)
 			elif isinstance(v, Currency):
 				new_dict[k] = CURRENCIES[v.value]
+			elif isinstance(v, Account):
+				new_dict[k] = v.name
 			else:
 				new_dict[k] = v
 		return new_dict
-	printable_report = make_printable(report)
-	log.info("CAP GAINS REPORT")
-	log.info(json.dumps(printable_report, indent=2, sort_keys=True))
 
-	filename = 'capgains.%s-%s.json' %(
-		start_time.strftime(Portfolio.DATETIME_FORMAT),
-		end_time.strftime(Portfolio.DATETIME_FORMAT))
+	if opts.validate:
+		from validate import LedgerValidator
+		validator = LedgerValidator(Portfolio.load(opts.type, start_time))
+		if opts.ledger_file:
+			with LedgerFile(opts.ledger_file) as ledger:
+				problems = validator.validate_range(end_time, ledger)
+		else:
+			problems = validator.validate_range(end_time)
+		if len(problems) > 0:
+			log.error('%d problems in the ledger between %s and %s\n%s' %(
+				len(problems), start_time.isoformat(), end_time.isoformat(),
+				LedgerValidator.format_problems(problems)))
+			sys.exit(1)
+
+	if opts.harvest is not None:
+		# Plan a loss harvest from the saved snapshot at end time
+		portfolio = Portfolio.load(opts.type, end_time)
+		if opts.lot_method is not None and opts.lot_method != portfolio._lot_method:
+			portfolio.set_lot_method(opts.lot_method)
+		prices = dict()
+		for price in opts.price:
+			currency, value = price.split('=')
+			prices[Currency[currency]] = Decimal(value)
+		from apis.coinbase import get_api
+		for currency in portfolio._wallets:
+			if currency not in prices:
+				prices[currency] = get_api('CoinbasePrime').get_usd_price(CURRENCIES[currency.value], end_time)
+		plan = portfolio.plan_harvest(prices, Decimal(str(opts.harvest)))
+		printable_report = make_printable(dict(plan,
+			candidates = [dict(candidate, acquired_at = candidate['acquired_at'].isoformat()) for candidate in plan['candidates']]))
+		log.info("HARVEST PLAN")
+		log.info(json.dumps(printable_report, indent=2, sort_keys=True))
+		prefix = 'harvest'
+	elif opts.simulate:
+		# Compare lot methods without touching the saved snapshots
+		simulation = CapGains.simulate(
+			name = opts.type,
+			start_time = start_time,
+			end_time = end_time,
+			lot_methods = opts.simulate.split(','),
+			pipelined = opts.pipelined,
+			ledger_file = opts.ledger_file)
+		log.info("LOT METHOD SIMULATION")
+		log.info('\n' + CapGains.format_simulation(simulation))
+		printable_report = make_printable(simulation)
+		prefix = 'simulation'
+	else:
+		# Run cap gains report
+		report = CapGains.report(
+			name = opts.type,
+			start_time = start_time,
+			end_time = end_time,
+			aging_days = opts.aging_days,
+			track_lifetimes = opts.lifetimes,
+			lot_method = opts.lot_method,
+			pipelined = opts.pipelined,
+			breakdowns = [breakdown.split(',') for breakdown in opts.breakdown],
+			ledger_file = opts.ledger_file)
+		printable_report = make_printable(report)
+		log.info("CAP GAINS REPORT")
+		log.info(json.dumps(printable_report, indent=2, sort_keys=True))
+		prefix = 'capgains'
+
+	if start_time is None:
+		filename = '%s.%s.json' %(prefix, end_time.strftime(Portfolio.DATETIME_FORMAT))
+	else:
+		filename = '%s.%s-%s.json' %(
+			prefix,
+			start_time.strftime(Portfolio.DATETIME_FORMAT),
+			end_time.strftime(Portfolio.DATETIME_FORMAT))
 	with open(os.path.join(account_dir, filename), 'w') as outfile:
 		json.dump(printable_report, outfile, indent=2, sort_keys=True)
+	log.debug('Connection pool: %s' %(pool_stats()))
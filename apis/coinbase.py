@@ -1,15 +1,18 @@
-import json, hmac, hashlib, time, requests, base64, logging, datetime
+import json, hmac, hashlib, time, base64, logging, datetime
 from requests.auth import AuthBase
 import re
 from calendar import timegm
 from decimal import Decimal
 
 from database import get_db_session
+from apis.transport import LiveTransport
+from util.lazy import LazyRegistry
 
 from models import Pagination, Account
 
 UNIX_EPOCH_START = datetime.datetime(1970, 1, 1, 0, 0, 0)
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+CANDLES_PER_REQUEST = 300 # Max candles returned by the candles endpoint
 
 class CoinbaseRestException(Exception):
 	def __init__(self, message):
@@ -59,18 +62,23 @@ def get_product_id_from_uri(uri):
 	return match.groups()[0]
 
 class AuthRequesterFactory(object):
-	def __init__(self, credentials):
+	def __init__(self, credentials, transport=None):
 		self._auth = ExchangeAuth(
 			api_key = credentials['api_key'],
 			secret = credentials['secret'],
 			passphrase = credentials['passphrase'])
 		self._base_url = 'https://' + credentials['base_url']
+		self._transport = transport or LiveTransport()
+		self._log = logging.getLogger('AuthRequesterFactory')
+
+	def set_transport(self, transport):
+		self._transport = transport
 
 	def __call__(self, uri):
 		method = 'GET'
 		url = self._base_url + uri
-		time.sleep(0.25)
-		response = requests.request(
+		self._transport.throttle()
+		response = self._transport.request(
 			method = method,
 			url = url,
 			auth = self._auth,
@@ -81,14 +89,14 @@ class AuthRequesterFactory(object):
 		method = 'GET'
 		response_data = []
 		url = self._base_url + uri
-		response = requests.request(
+		response = self._transport.request(
 			method = method,
 			url = url,
 			params = {'after': after},
 			auth = self._auth,
 			verify = True)
-		print(response)
-		print(response.text)
+		self._log.debug('GET %s after=%s status=%d', url, after, response.status_code,
+			extra={'rate_limit': True})
 		if isinstance(response.json(), list):
 			response_data += response.json()
 		else:
@@ -97,6 +105,7 @@ class AuthRequesterFactory(object):
 			for r in response_data:
 				yield r
 		else:
+			# The calling thread's session from the shared registry, the caller owns it
 			db_session = get_db_session()
 			pagination_key = paginate_until['key']
 			pagination_condition = paginate_until['condition']
@@ -107,11 +116,13 @@ class AuthRequesterFactory(object):
 					yield r
 			while pagination_condition(response_data[-1][pagination_key]):
 				if 'CB-AFTER' in response.headers:
-					time.sleep(0.25) # To avoid rate limit
+					self._transport.throttle() # To avoid rate limit
 					after = response.headers['CB-AFTER']
-					response = requests.request(
+					response = self._transport.request(
 						method=method, url=url, auth=self._auth, params={'after': after})
 					response_data = response.json()
+					self._log.debug('GET %s after=%s status=%d', url, after, response.status_code,
+						extra={'rate_limit': True})
 					if not isinstance(response_data, list):
 						response_data = [response_data]
 					if len(response_data) == 0:
@@ -132,19 +143,24 @@ class AuthRequesterFactory(object):
 						db_session.add(pagination)
 						db_session.commit()
 					except Exception as e:
-						print(str(e))
+						self._log.warning('Failed to record pagination: %s' %(str(e)))
 						# Let this go since it's just extra info that is nice to have
+						db_session.rollback()
 				else:
 					break
-			db_session.remove()
 
 class Api(object):
-	def __init__(self, api_config):
+	def __init__(self, api_config, transport=None):
 		self._api_config = api_config
-		self._requester = AuthRequesterFactory(api_config)
+		self._requester = AuthRequesterFactory(api_config, transport)
+		self._log = logging.getLogger('Api')
+
+	def set_transport(self, transport):
+		self._requester.set_transport(transport)
 
 	def get_usd_price(self, currency, dt):
-		print('get_usd_price(): currency=%s, dt=%s' %(currency, dt))
+		self._log.debug('get_usd_price(): currency=%s, dt=%s', currency, dt,
+			extra={'rate_limit': True})
 		if currency == 'BCHSV':
 			return Decimal(0.0)
 		if currency == 'XRP':
@@ -180,10 +196,38 @@ class Api(object):
 				raise Exception('No XRP price for that date')
 		if isinstance(dt, str):
 			dt = datetime.datetime.strptime(dt, '%Y-%m-%dT%H:%M:%S.%fZ')
-		product_id = '%s-USD' %(currency)
 		# Get candles by the minute around the requested time
 		end = dt + datetime.timedelta(minutes = 150)
 		start = dt - datetime.timedelta(minutes = 150)
+		candles = self.get_candles(currency, start, end)
+		return self.price_from_candles(candles, dt)
+
+	def get_usd_prices(self, currency, dts):
+		# Deduplicates the requested times and coalesces those that fall in
+		# the same window into a single candles request
+		dts = sorted(set(
+			datetime.datetime.strptime(dt, '%Y-%m-%dT%H:%M:%S.%fZ') if isinstance(dt, str) else dt
+			for dt in dts))
+		prices = dict()
+		if currency in ('BCHSV', 'XRP'):
+			for dt in dts:
+				prices[dt] = self.get_usd_price(currency, dt)
+			return prices
+		index = 0
+		while index < len(dts):
+			start = dts[index] - datetime.timedelta(minutes = 5)
+			end = start + datetime.timedelta(minutes = CANDLES_PER_REQUEST - 1)
+			batch = list()
+			while index < len(dts) and dts[index] <= end:
+				batch.append(dts[index])
+				index += 1
+			candles = self.get_candles(currency, start, end)
+			for dt in batch:
+				prices[dt] = self.price_from_candles(candles, dt)
+		return prices
+
+	def get_candles(self, currency, start, end):
+		product_id = '%s-USD' %(currency)
 		uri = '/products/%s/candles?start=%s&end=%s&granularity=60' %(
 			product_id,
 			start.isoformat(),
@@ -191,9 +235,15 @@ class Api(object):
 		response = self._requester(uri)
 		if not isinstance(response, list) or len(response) == 0:
 			raise Exception('Unexcepted non-list or empty response')
+		return response
+
+	@staticmethod
+	def price_from_candles(candles, dt):
 		# Determine the candle that is closest without being under
 		requested_time = timegm(dt.timetuple())
-		relevant_candle = next(v for ind, v in enumerate(response) if v[0] <= requested_time)
+		relevant_candle = next((v for v in candles if v[0] <= requested_time), None)
+		if relevant_candle is None:
+			raise Exception('Could not find price within 5 minute of requested time')
 		candle_time, low, high, open, close, volume = relevant_candle
 		if abs(candle_time - requested_time) > 300.0:
 			raise Exception('Could not find price within 5 minute of requested time')
@@ -210,9 +260,28 @@ class Api(object):
 		for fill in self._requester.generate(endpoint, paginate_until, after):
 			yield fill
 
-from config import api_config
-CoinbasePrimeApi = Api(api_config['CoinbasePrime'])
-CoinbaseProApi = Api(api_config['CoinbasePro'])
+def _api_factory(name):
+	def factory():
+		# Only the entry for the requested api has to be in config.py
+		from config import api_config
+		if name not in api_config:
+			raise Exception('No api_config entry for "%s"' %(name))
+		return Api(api_config[name])
+	return factory
+
+apis = LazyRegistry('apis')
+apis.register('CoinbasePrime', _api_factory('CoinbasePrime'))
+apis.register('CoinbasePro', _api_factory('CoinbasePro'))
+
+def get_api(name):
+	return apis.get(name)
+
+def __getattr__(name):
+	# Keeps "from apis.coinbase import CoinbasePrimeApi" working while
+	# deferring construction until first use
+	if name in ('CoinbasePrimeApi', 'CoinbaseProApi'):
+		return get_api(name[:-3])
+	raise AttributeError("module '%s' has no attribute '%s'" %(__name__, name))
 
 if __name__ == '__main__':
 
@@ -221,5 +290,5 @@ if __name__ == '__main__':
 	#for fill in CoinbasePrimeApi.get_fills('BTC-USD', '2019-02-20T14:12:46.000Z'):
 	#	print(json.dumps(fill, indent=2, sort_keys=True))
 
-	price = CoinbaseProApi.get_usd_price('ETH', '2018-12-31T21:59:59.999Z')
+	price = get_api('CoinbasePro').get_usd_price('ETH', '2018-12-31T21:59:59.999Z')
 	print(price)
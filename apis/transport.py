@@ -0,0 +1,110 @@
+import datetime, gzip, hashlib, json, logging, os, time
+import requests
+from requests.structures import CaseInsensitiveDict
+
+class ArchiveMissException(Exception):
+	def __init__(self, message):
+		self._message = message
+
+	def __str__(self):
+		return repr(self._message)
+
+def request_key(method, url, params=None):
+	# Auth headers change on every request so only the method, url and
+	# the (non-empty) query params identify a page
+	params = sorted((k, str(v)) for k, v in (params or {}).items() if v is not None)
+	message = json.dumps([method.upper(), url, params])
+	return hashlib.sha1(message.encode('utf8')).hexdigest()
+
+class ArchivedResponse(object):
+	def __init__(self,
+		status_code,
+		headers,
+		text,
+		url = None):
+		self.status_code = status_code
+		self.headers = CaseInsensitiveDict(headers)
+		self.text = text
+		self.url = url
+
+	def json(self):
+		return json.loads(self.text)
+
+	def __repr__(self):
+		return '<ArchivedResponse [%d]>' %(self.status_code)
+
+class LiveTransport(object):
+	def __init__(self, rate_limit = 0.25):
+		self._rate_limit = rate_limit
+
+	def throttle(self):
+		time.sleep(self._rate_limit)
+
+	def request(self, method, url, params=None, auth=None, verify=True):
+		return requests.request(
+			method = method,
+			url = url,
+			params = params,
+			auth = auth,
+			verify = verify)
+
+class RecordingTransport(LiveTransport):
+	def __init__(self, archive_dir, rate_limit = 0.25):
+		super(RecordingTransport, self).__init__(rate_limit)
+		self._archive_dir = archive_dir
+		self._log = logging.getLogger('RecordingTransport')
+		if not os.path.isdir(archive_dir):
+			os.makedirs(archive_dir)
+
+	def request(self, method, url, params=None, auth=None, verify=True):
+		response = super(RecordingTransport, self).request(method, url, params, auth, verify)
+		key = request_key(method, url, params)
+		record = {
+			'method': method,
+			'url': url,
+			'params': params,
+			'status_code': response.status_code,
+			'headers': dict(response.headers),
+			'text': response.text,
+			'recorded_at': datetime.datetime.utcnow().isoformat()
+		}
+		# Write to a temp file first so an interrupted run never leaves a
+		# truncated page behind for replay
+		filepath = os.path.join(self._archive_dir, '%s.json.gz' %(key))
+		with gzip.open(filepath + '.tmp', 'wt', encoding='utf8') as archive_file:
+			json.dump(record, archive_file)
+		os.replace(filepath + '.tmp', filepath)
+		self._log.debug('Archived %s %s -> %s' %(method, url, key))
+		return response
+
+class ReplayTransport(object):
+	def __init__(self, archive_dir):
+		if not os.path.isdir(archive_dir):
+			raise Exception('Archive directory "%s" does not exist' %(archive_dir))
+		self._archive_dir = archive_dir
+
+	def throttle(self):
+		# No rate limit when reading from disk
+		pass
+
+	def request(self, method, url, params=None, auth=None, verify=True):
+		key = request_key(method, url, params)
+		filepath = os.path.join(self._archive_dir, '%s.json.gz' %(key))
+		if not os.path.exists(filepath):
+			raise ArchiveMissException('No archived response for %s %s params=%s' %(method, url, params))
+		with gzip.open(filepath, 'rt', encoding='utf8') as archive_file:
+			record = json.load(archive_file)
+		return ArchivedResponse(
+			status_code = record['status_code'],
+			headers = record['headers'],
+			text = record['text'],
+			url = record['url'])
+
+def make_transport(record_dir=None, replay_dir=None):
+	if record_dir is not None and replay_dir is not None:
+		raise Exception('Cannot both record to and replay from an archive')
+	if record_dir is not None:
+		return RecordingTransport(record_dir)
+	if replay_dir is not None:
+		return ReplayTransport(replay_dir)
+	return LiveTransport()
@@ -0,0 +1,159 @@
+import datetime
+import json
+import logging
+import os
+
+from sqlalchemy import func, or_, text
+
+from models import Transaction, LedgerChange, Currency
+
+# Postgres delivers this on commit to anything listening, e.g. service.py
+NOTIFY_CHANNEL = 'ledger_changes'
+
+# Change ids, recorded_at and ingested_at are all taken before commit, so a
+# row can turn up behind a watermark saved in the meantime. Every scan looks
+# back this far and skips the rows the watermark lists as absorbed.
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+WATERMARK_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def to_currency_enum(currency):
+	if isinstance(currency, Currency):
+		return currency
+	return Currency[currency]
+
+def record_changes(db_session, changes):
+	# changes are (transaction_id, from_currency, to_currency, transacted_at);
+	# the caller commits them with the transactions they describe
+	for transaction_id, from_currency, to_currency, transacted_at in changes:
+		currencies = set([to_currency_enum(from_currency), to_currency_enum(to_currency)])
+		currencies.discard(Currency.USD)
+		for currency in currencies:
+			db_session.add(LedgerChange(
+				transaction_id = transaction_id,
+				currency = currency,
+				transacted_at = transacted_at))
+	if len(changes) > 0 and db_session.get_bind().dialect.name == 'postgresql':
+		db_session.execute(text('NOTIFY %s' %(NOTIFY_CHANNEL)))
+
+class ChangeTracker(object):
+	# Remembers, per portfolio, how far into ledger_changes and into
+	# transactions.ingested_at it has already absorbed. The ingested_at scan
+	# catches rows written without going through an ingester.
+	def __init__(self, name):
+		self._name = name
+		self._filepath = os.path.join('data', name, 'changes.json')
+		self._log = logging.getLogger('ChangeTracker')
+
+	def load_watermark(self):
+		if not os.path.exists(self._filepath):
+			return None
+		with open(self._filepath, 'r') as infile:
+			data = json.load(infile)
+		def parse(time):
+			return datetime.datetime.strptime(time, WATERMARK_TIME_FORMAT) if time else None
+		# Watermarks saved before the overlap scan have no recorded_at or ids
+		return {
+			'last_change_id': data['last_change_id'],
+			'recorded_at': parse(data.get('recorded_at')),
+			'ingested_at': parse(data['ingested_at']),
+			'change_ids': data.get('change_ids', list()),
+			'transaction_ids': data.get('transaction_ids', list())
+		}
+
+	def save_watermark(self, watermark):
+		def format(time):
+			return time.strftime(WATERMARK_TIME_FORMAT) if time else None
+		with open(self._filepath, 'w') as outfile:
+			json.dump({
+				'last_change_id': watermark['last_change_id'],
+				'recorded_at': format(watermark['recorded_at']),
+				'ingested_at': format(watermark['ingested_at']),
+				'change_ids': sorted(watermark['change_ids']),
+				'transaction_ids': sorted(watermark['transaction_ids'])
+			}, outfile, indent=2, sort_keys=True)
+
+	def absorbed(self, watermark):
+		# Whether a saved watermark has caught up with watermark, i.e. every
+		# change current back then has been absorbed into the snapshots
+		saved = self.load_watermark()
+		if saved is None or saved['last_change_id'] < watermark['last_change_id']:
+			return False
+		if watermark['ingested_at'] is None:
+			return True
+		return saved['ingested_at'] is not None and saved['ingested_at'] >= watermark['ingested_at']
+
+	def current_watermark(self, db_session):
+		return {
+			'last_change_id': db_session.query(func.max(LedgerChange.id)).scalar() or 0,
+			'recorded_at': db_session.query(func.max(LedgerChange.recorded_at)).scalar(),
+			'ingested_at': db_session.query(func.max(Transaction.ingested_at)).scalar(),
+			'change_ids': list(),
+			'transaction_ids': list()
+		}
+
+	def pending(self, db_session, portfolio_filters):
+		# Returns ({currency: earliest affected transacted_at}, new watermark)
+		watermark = self.load_watermark()
+		if watermark is None:
+			self._log.info('No watermark for "%s", starting from now' %(self._name))
+			# Rows in the overlap are listed as absorbed, not reported
+			affected, watermark = self.scan(db_session, portfolio_filters, self.current_watermark(db_session))
+			return dict(), watermark
+		return self.scan(db_session, portfolio_filters, watermark)
+
+	def scan(self, db_session, portfolio_filters, watermark):
+		affected = dict()
+		def affect(currency, transacted_at):
+			if currency == Currency.USD or transacted_at is None:
+				return
+			if currency not in affected or transacted_at < affected[currency]:
+				affected[currency] = transacted_at
+		last_change_id = watermark['last_change_id']
+		recorded_at = watermark['recorded_at']
+		ingested_at = watermark['ingested_at']
+		seen_changes = set(watermark['change_ids'])
+		seen_transactions = set(watermark['transaction_ids'])
+
+		changes = db_session.query(LedgerChange.id, LedgerChange.currency, LedgerChange.transacted_at, LedgerChange.recorded_at)\
+			.join(Transaction, Transaction.id == LedgerChange.transaction_id)\
+			.filter(*portfolio_filters)
+		if recorded_at is not None:
+			changes = changes.filter(or_(
+				LedgerChange.id > last_change_id,
+				LedgerChange.recorded_at > recorded_at - WATERMARK_OVERLAP))
+		else:
+			changes = changes.filter(LedgerChange.id > last_change_id)
+		recent_changes = dict()
+		for change_id, currency, transacted_at, change_recorded_at in changes:
+			if change_id not in seen_changes:
+				affect(currency, transacted_at)
+			recent_changes[change_id] = change_recorded_at
+			last_change_id = max(last_change_id, change_id)
+			if change_recorded_at is not None and (recorded_at is None or change_recorded_at > recorded_at):
+				recorded_at = change_recorded_at
+
+		transactions = db_session.query(Transaction.id, Transaction.from_currency, Transaction.to_currency, Transaction.transacted_at, Transaction.ingested_at)\
+			.filter(*portfolio_filters)
+		if ingested_at is not None:
+			transactions = transactions.filter(Transaction.ingested_at > ingested_at - WATERMARK_OVERLAP)
+		recent_transactions = dict()
+		for transaction_id, from_currency, to_currency, transacted_at, transaction_ingested_at in transactions:
+			if transaction_id not in seen_transactions:
+				affect(from_currency, transacted_at)
+				affect(to_currency, transacted_at)
+			recent_transactions[transaction_id] = transaction_ingested_at
+			if transaction_ingested_at is not None and (ingested_at is None or transaction_ingested_at > ingested_at):
+				ingested_at = transaction_ingested_at
+
+		def recent(rows, latest):
+			# Only rows the next scan's overlap reaches need remembering
+			if latest is None:
+				return list()
+			return [row_id for row_id, time in rows.items() if time is not None and time > latest - WATERMARK_OVERLAP]
+		return affected, {
+			'last_change_id': last_change_id,
+			'recorded_at': recorded_at,
+			'ingested_at': ingested_at,
+			'change_ids': recent(recent_changes, recorded_at),
+			'transaction_ids': recent(recent_transactions, ingested_at)
+		}
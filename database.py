@@ -1,20 +1,95 @@
+import threading
+import time
+
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from models import Base
-from config import db_config
+from util.lazy import LazyRegistry
 
-engine = create_engine(
-	'postgresql://%s:%s@%s/%s' %(
-		db_config['username'],
-		db_config['password'],
-		db_config['host'],
-		db_config['dbname']))
+POOL_DEFAULTS = {
+	'pool_size': 5,
+	'max_overflow': 10,
+	'pool_timeout': 30,
+	'pool_pre_ping': True,
+	'pool_recycle': 1800,
+}
 
-def get_db_session():
-	db_session = scoped_session(
+class TimedQueuePool(QueuePool):
+	# QueuePool that counts checkouts and the time spent waiting for them
+	def __init__(self, *args, **kwargs):
+		super(TimedQueuePool, self).__init__(*args, **kwargs)
+		self._stats_lock = threading.Lock()
+		self._num_checkouts = 0
+		self._total_wait = 0.0
+		self._max_wait = 0.0
+
+	def _do_get(self):
+		start = time.monotonic()
+		try:
+			return super(TimedQueuePool, self)._do_get()
+		finally:
+			wait = time.monotonic() - start
+			with self._stats_lock:
+				self._num_checkouts += 1
+				self._total_wait += wait
+				self._max_wait = max(self._max_wait, wait)
+
+	def stats(self):
+		with self._stats_lock:
+			return {
+				'checkouts': self._num_checkouts,
+				'total_wait': self._total_wait,
+				'max_wait': self._max_wait,
+				'size': self.size(),
+				'checked_out': self.checkedout(),
+				'overflow': self.overflow()
+			}
+
+def _create_engine():
+	from config import db_config
+	pool_options = dict(
+		(key, db_config.get(key, default)) for key, default in POOL_DEFAULTS.items())
+	return create_engine(
+		'postgresql://%s:%s@%s/%s' %(
+			db_config['username'],
+			db_config['password'],
+			db_config['host'],
+			db_config['dbname']),
+		poolclass = TimedQueuePool,
+		**pool_options)
+
+def _create_sessions():
+	# One registry for the process, each thread gets its own session
+	return scoped_session(
 		sessionmaker(
 			autocommit = False,
 			autoflush = False,
-			bind = engine))
-	return db_session
+			bind = get_engine()))
+
+resources = LazyRegistry('database')
+resources.register('engine', _create_engine, teardown=lambda engine: engine.dispose())
+resources.register('sessions', _create_sessions, teardown=lambda sessions: sessions.remove())
+
+def get_engine():
+	return resources.get('engine')
+
+def reset_engine():
+	resources.reset('sessions')
+	resources.reset('engine')
+
+def get_db_session():
+	return resources.get('sessions')
+
+def pool_stats():
+	if not resources.is_created('engine'):
+		return None
+	pool = get_engine().pool
+	if not isinstance(pool, TimedQueuePool):
+		return None
+	return pool.stats()
 
+def __getattr__(name):
+	if name == 'engine':
+		return get_engine()
+	raise AttributeError("module '%s' has no attribute '%s'" %(__name__, name))
@@ -6,6 +6,12 @@ db_config = {
 	'password': '<PASSWORD>'
 	'host': '<HOSTNAME>'
 	'dbname': '<DBNAME>'
+	# Optional connection pool settings
+	# 'pool_size': 5
+	# 'max_overflow': 10
+	# 'pool_timeout': 30
+	# 'pool_pre_ping': True
+	# 'pool_recycle': 1800
 }
 
 # Edit credentials for the various apis you need
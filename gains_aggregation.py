@@ -0,0 +1,116 @@
+from decimal import Decimal
+
+HOLDING_PERIOD_BUCKETS = (
+	(30, '<30d'),
+	(90, '30-90d'),
+	(365, '90d-1y'),
+	(730, '1-2y'),
+)
+
+def holding_period_bucket(days):
+	for limit, label in HOLDING_PERIOD_BUCKETS:
+		if days < limit:
+			return label
+	return '2y+'
+
+class GainsColumns(object):
+	# Cap gain events gathered into one list per field. The matching loop only
+	# appends; grouping works a column at a time once the run is over. Amounts
+	# stay Decimal so totals match the per event arithmetic exactly.
+	MEASURES = ('qty', 'cost_basis', 'proceeds', 'gain')
+
+	def __init__(self):
+		self._currency = list()
+		self._account = list()
+		self._is_short_term = list()
+		self._purchased_at = list()
+		self._sold_at = list()
+		self._qty = list()
+		self._cost_basis = list()
+		self._proceeds = list()
+		self._gain = list()
+
+	def __len__(self):
+		return len(self._gain)
+
+	def add_events(self, events):
+		for event in events:
+			self._currency.append(event._currency)
+			self._account.append(event._account)
+			self._is_short_term.append(event._is_short_term)
+			self._purchased_at.append(event._purchased_at)
+			self._sold_at.append(event._sold_at)
+			self._qty.append(event._qty)
+			self._cost_basis.append(event._cost_basis)
+			self._proceeds.append(event._proceeds)
+			self._gain.append(event._gain)
+
+	def dimension(self, name):
+		if name == 'currency':
+			return self._currency
+		if name == 'account':
+			return self._account
+		if name == 'term':
+			return ['short' if is_short else 'long' for is_short in self._is_short_term]
+		if name == 'month':
+			return ['%04d-%02d' %(sold_at.year, sold_at.month) for sold_at in self._sold_at]
+		if name == 'year':
+			return [sold_at.year for sold_at in self._sold_at]
+		if name == 'holding_period':
+			return [holding_period_bucket((sold_at - purchased_at).days)
+				for sold_at, purchased_at in zip(self._sold_at, self._purchased_at)]
+		raise Exception('Unrecognized dimension "%s"' %(name))
+
+	def group_ids(self, dimensions):
+		# Maps every event to a dense group id, keys in first seen order
+		if len(dimensions) == 0:
+			return [()], [0] * len(self)
+		keys = list()
+		index = dict()
+		ids = list()
+		for key in zip(*[self.dimension(name) for name in dimensions]):
+			group_id = index.get(key)
+			if group_id is None:
+				group_id = index[key] = len(keys)
+				keys.append(key)
+			ids.append(group_id)
+		return keys, ids
+
+	@staticmethod
+	def _sum(ids, column, num_groups):
+		totals = [Decimal(0.0)] * num_groups
+		for group_id, value in zip(ids, column):
+			totals[group_id] += value
+		return totals
+
+	@staticmethod
+	def _extreme(ids, column, num_groups, pick):
+		extremes = [None] * num_groups
+		for group_id, value in zip(ids, column):
+			current = extremes[group_id]
+			extremes[group_id] = value if current is None else pick(current, value)
+		return extremes
+
+	def group_by(self, dimensions):
+		keys, ids = self.group_ids(dimensions)
+		num_groups = len(keys)
+		counts = [0] * num_groups
+		for group_id in ids:
+			counts[group_id] += 1
+		totals = dict((measure, self._sum(ids, getattr(self, '_' + measure), num_groups)) for measure in GainsColumns.MEASURES)
+		purchased_min = self._extreme(ids, self._purchased_at, num_groups, min)
+		purchased_max = self._extreme(ids, self._purchased_at, num_groups, max)
+		sold_min = self._extreme(ids, self._sold_at, num_groups, min)
+		sold_max = self._extreme(ids, self._sold_at, num_groups, max)
+		rows = list()
+		for group_id, key in enumerate(keys):
+			if counts[group_id] == 0:
+				continue
+			row = dict(zip(dimensions, key))
+			row['count'] = counts[group_id]
+			for measure in GainsColumns.MEASURES:
+				row[measure] = totals[measure][group_id]
+			row['purchased_range'] = [purchased_min[group_id].isoformat(), purchased_max[group_id].isoformat()]
+			row['sold_range'] = [sold_min[group_id].isoformat(), sold_max[group_id].isoformat()]
+			rows.append(row)
+		return rows
@@ -1,72 +1,156 @@
 import datetime
+from collections import defaultdict
 from decimal import Decimal
 import logging
-import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
 
-from apis.coinbase import CoinbasePrimeApi, CoinbaseProApi
-from models import Transaction, Account
+from apis.coinbase import get_api
+from apis.transport import make_transport
+from models import Transaction, StagedFill, Account
 from database import get_db_session
+from changes import record_changes
 
 class TransactionIngester(object):
-	def __init__(self, account):
-		if account == 'CoinbasePro':
-			self._api = CoinbaseProApi
-		elif account == 'CoinbasePrime':
-			self._api = CoinbasePrimeApi
+	def __init__(self, account, transport=None):
+		if account in ('CoinbasePro', 'CoinbasePrime'):
+			self._api = get_api(account)
 		else:
 			raise Exception('Unrecognized account "%s"' %(opts.account))
+		if transport is not None:
+			self._api.set_transport(transport)
 		self._account = account
 		self._log = logging.getLogger('TransactionIngester')
 
-	def upsert_fill(self, fill, db_session):
-		try:
-			if fill['side'] == 'sell':
-				from_currency, to_currency = fill['product_id'].split('-')
-				from_amount = Decimal(fill['size'])
-				to_amount = Decimal(fill['size']) * Decimal(fill['price'])
-			elif fill['side'] == 'buy':
-				to_currency, from_currency = fill['product_id'].split('-')
-				from_amount = Decimal(fill['size']) * Decimal(fill['price'])
-				to_amount = Decimal(fill['size'])
-			else:
+	@staticmethod
+	def fill_external_id(fill):
+		return '%d:%s' %(fill['trade_id'], fill['order_id'])
+
+	def transaction_values(self, external_id, product_id, side, size, price, fee, usd_volume, created_at):
+		if side == 'sell':
+			from_currency, to_currency = product_id.split('-')
+			from_amount = Decimal(size)
+			to_amount = Decimal(size) * Decimal(price)
+		elif side == 'buy':
+			to_currency, from_currency = product_id.split('-')
+			from_amount = Decimal(size) * Decimal(price)
+			to_amount = Decimal(size)
+		else:
+			raise Exception('Unrecognized side "%s"' %(side))
+		return {
+			'external_id': external_id,
+			'from_account': self._account,
+			'from_currency': from_currency,
+			'from_amount': from_amount,
+			'to_account': self._account,
+			'to_currency': to_currency,
+			'to_amount': to_amount,
+			'usd_value': usd_volume,
+			'fee': fee,
+			'transacted_at': created_at
+		}
+
+	def stage_fills(self, fills, db_session, batch_size=500):
+		# Stage 1: write raw fills as fast as pages arrive, no price lookups
+		num_staged = 0
+		batch = list()
+		for fill in fills:
+			if fill['side'] not in ('buy', 'sell'):
 				raise Exception('Unrecognized side "%s"' %(fill['side']))
-			if fill['usd_volume']:
-				usd_volume = fill['usd_volume']
-			else:
-				if fill['product_id'].find('USD') == -1:
-					base, quote = fill['product_id'].split('-')
-					usd_price = self._api.get_usd_price(base, fill['created_at'])
-					usd_volume = usd_price * Decimal(fill['size'])
-				else:
-					usd_volume = Decimal(fill['price']) * Decimal(fill['size'])
-			txn = Transaction(
-				external_id = '%d:%s' %(fill['trade_id'], fill['order_id']),
-				from_account = self._account,
-				from_currency = from_currency,
-				from_amount = from_amount,
-				to_account = self._account,
-				to_currency = to_currency,
-				to_amount = to_amount,
-				usd_value = usd_volume,
-				fee = fill['fee'],
-				transacted_at = fill['created_at'])
-			db_session.add(txn)
-			db_session.commit()
-		# Ignore duplicate key value issues, it's already there
-		except sqlalchemy.exc.IntegrityError as e:
-			if not str(e).find('duplicate key value violates unique constraint') > -1:
-				raise e
-			db_session.rollback()
+			batch.append({
+				'account': self._account,
+				'external_id': self.fill_external_id(fill),
+				'product_id': fill['product_id'],
+				'side': fill['side'],
+				'size': fill['size'],
+				'price': fill['price'],
+				'fee': fill['fee'],
+				'usd_volume': fill['usd_volume'] or None,
+				'created_at': fill['created_at']
+			})
+			if len(batch) >= batch_size:
+				num_staged += self._insert_staged(batch, db_session)
+				batch = list()
+		if len(batch) > 0:
+			num_staged += self._insert_staged(batch, db_session)
+		return num_staged
+
+	def _insert_staged(self, rows, db_session):
+		statement = insert(StagedFill).values(rows)\
+			.on_conflict_do_nothing(index_elements=['external_id'])
+		db_session.execute(statement)
+		db_session.commit()
+		return len(rows)
+
+	def staged_usd_volume(self, staged_fill, usd_prices):
+		if staged_fill.usd_volume is not None:
+			return staged_fill.usd_volume
+		if staged_fill.product_id.find('USD') == -1:
+			base, quote = staged_fill.product_id.split('-')
+			return usd_prices[(base, staged_fill.created_at)] * staged_fill.size
+		return staged_fill.price * staged_fill.size
+
+	def promote_staged_fills(self, batch_size=1000):
+		# Stage 2: value every unpromoted fill with one coalesced set of price
+		# lookups, then move them into transactions
+		db_session = get_db_session()
+		try:
+			staged_fills = db_session.query(StagedFill)\
+				.filter(StagedFill.account == self._account)\
+				.filter(StagedFill.promoted_at == None)\
+				.order_by(StagedFill.created_at.asc())\
+				.all()
+			self._log.info('Found %d staged fills to promote' %(len(staged_fills)))
+			lookups = defaultdict(set)
+			for staged_fill in staged_fills:
+				if staged_fill.usd_volume is None and staged_fill.product_id.find('USD') == -1:
+					base, quote = staged_fill.product_id.split('-')
+					lookups[base].add(staged_fill.created_at)
+			usd_prices = dict()
+			for base, dts in lookups.items():
+				self._log.info('Looking up %d USD prices for "%s"' %(len(dts), base))
+				for dt, price in self._api.get_usd_prices(base, dts).items():
+					usd_prices[(base, dt)] = price
+			for start in range(0, len(staged_fills), batch_size):
+				batch = staged_fills[start:start + batch_size]
+				rows = [self.transaction_values(
+						external_id = staged_fill.external_id,
+						product_id = staged_fill.product_id,
+						side = staged_fill.side,
+						size = staged_fill.size,
+						price = staged_fill.price,
+						fee = staged_fill.fee,
+						usd_volume = self.staged_usd_volume(staged_fill, usd_prices),
+						created_at = staged_fill.created_at)
+					for staged_fill in batch]
+				# Fills already in transactions are left as they are
+				statement = insert(Transaction).values(rows)\
+					.on_conflict_do_nothing(index_elements=['external_id'])\
+					.returning(
+						Transaction.id,
+						Transaction.from_currency,
+						Transaction.to_currency,
+						Transaction.transacted_at)
+				record_changes(db_session, db_session.execute(statement).fetchall())
+				promoted_at = datetime.datetime.utcnow()
+				for staged_fill in batch:
+					staged_fill.promoted_at = promoted_at
+				db_session.commit()
+			return len(staged_fills)
 		except Exception as e:
+			db_session.rollback()
 			raise e
+		finally:
+			db_session.close()
 
 	def get_fills(self, backwards_until, afters):
 		db_session = get_db_session()
 		try:
 			for product_id, after in afters.items():
 				self._log.info('Ingesting fills for product "%s"' %(product_id))
-				for fill in self._api.get_fills(product_id, backwards_until, after):
-					self.upsert_fill(fill, db_session)
+				num_staged = self.stage_fills(
+					self._api.get_fills(product_id, backwards_until, after),
+					db_session)
+				self._log.info('Staged %d fills for product "%s"' %(num_staged, product_id))
 		except Exception as e:
 			db_session.rollback()
 			raise e
@@ -82,18 +166,40 @@ if __name__ == '__main__':
 	parser.add_option('-L', '--log-level',
 		default = 'INFO',
 		help = 'log level {DEBUG, INFO, WARNING, ERROR, CRITICAL}. [%default]')
+	parser.add_option('-J', '--log-json',
+		action='store_true',
+		default=False,
+		help='Log JSON Lines instead of text')
+	parser.add_option('-Q', '--log-queue',
+		action='store_true',
+		default=False,
+		help='Hand log records to a background thread so callers never wait on log I/O')
 	parser.add_option('-a', '--account',
 		type=str,
 		help='Name of the account to ingest for {CoinbasePrime, CoinbasePro}')
 	parser.add_option('-u', '--backwards-until',
 		type=str,
 		help='String of datetime to ingest backwards until {2019-01-19T13:59:12.562Z}')
+	parser.add_option('-r', '--record-dir',
+		type=str,
+		help='Archive every raw API response page to this directory')
+	parser.add_option('-p', '--replay-dir',
+		type=str,
+		help='Replay API responses from this archive directory instead of the network')
+	parser.add_option('--stage-only',
+		action='store_true',
+		default=False,
+		help='Only stage raw fills, do not value and promote them to transactions')
+	parser.add_option('--promote-only',
+		action='store_true',
+		default=False,
+		help='Only value and promote already staged fills')
 	(opts, args) = parser.parse_args()
 
 	import logging
 	import os
 	from util import log_setup
-	log_setup.setupLogging(opts.log_level)
+	log_setup.setupLogging(opts.log_level, json_lines=opts.log_json, queued=opts.log_queue)
 	log = logging.getLogger('create_trader')
 
 	# Set afters to control what gets ingested
@@ -105,5 +211,11 @@ if __name__ == '__main__':
 		'BCH-USD': None,
 	}
 
-	ingester = TransactionIngester(opts.account)
-	ingester.get_fills(opts.backwards_until, afters)
+	transport = make_transport(
+		record_dir = opts.record_dir,
+		replay_dir = opts.replay_dir)
+	ingester = TransactionIngester(opts.account, transport)
+	if not opts.promote_only:
+		ingester.get_fills(opts.backwards_until, afters)
+	if not opts.stage_only:
+		ingester.promote_staged_fills()
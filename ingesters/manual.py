@@ -1,37 +1,70 @@
 from models import Transaction, Account
 from database import get_db_session
+from changes import record_changes
 import logging
 import sqlalchemy
+from sqlalchemy import or_, update
 
 class TransactionIngester(object):
 	def __init__(self, filepath):
 		if not os.path.exists(filepath):
 			raise Exception('File "%s" does not exist' %(filepath))
 		self._filepath = filepath
+		self._log = logging.getLogger('TransactionIngester')
 
 	def upsert_transaction(self, row, db_session):
+		values = dict((key, row[key]) for key in (
+			'external_id',
+			'from_account',
+			'from_currency',
+			'from_amount',
+			'to_account',
+			'to_currency',
+			'to_amount',
+			'usd_value',
+			'fee',
+			'transacted_at'))
 		try:
-			txn = Transaction(
-				external_id = row['external_id'],
-				from_account = row['from_account'],
-				from_currency = row['from_currency'],
-				from_amount = row['from_amount'],
-				to_account = row['to_account'],
-				to_currency = row['to_currency'],
-				to_amount = row['to_amount'],
-				usd_value = row['usd_value'],
-				fee = row['fee'],
-				transacted_at = row['transacted_at'])
+			txn = Transaction(**values)
 			db_session.add(txn)
+			db_session.flush()
+			record_changes(db_session, [(txn.id, txn.from_currency, txn.to_currency, txn.transacted_at)])
 			db_session.commit()
-		# Ignore duplicate key value issues, it's already there
+		# Already there, apply it as a correction if anything differs
 		except sqlalchemy.exc.IntegrityError as e:
 			if not str(e).find('duplicate key value violates unique constraint') > -1:
 				raise e
 			db_session.rollback()
+			self.correct_transaction(values, db_session)
 		except Exception as e:
 			raise e
 
+	def correct_transaction(self, values, db_session):
+		changed_columns = [Transaction.__table__.c[key].is_distinct_from(value)
+			for key, value in values.items() if key != 'external_id']
+		original = db_session.query(
+				Transaction.id,
+				Transaction.from_currency,
+				Transaction.to_currency,
+				Transaction.transacted_at)\
+			.filter(Transaction.external_id == values['external_id'])\
+			.one()
+		statement = update(Transaction)\
+			.where(Transaction.external_id == values['external_id'])\
+			.where(or_(*changed_columns))\
+			.values(**values)\
+			.returning(
+				Transaction.id,
+				Transaction.from_currency,
+				Transaction.to_currency,
+				Transaction.transacted_at)
+		corrected = db_session.execute(statement).fetchall()
+		if len(corrected) > 0:
+			self._log.info('Corrected transaction "%s"' %(values['external_id']))
+			# Both the old and the new position of the row are affected
+			record_changes(db_session, [tuple(original)] + [tuple(row) for row in corrected])
+		db_session.commit()
+
 	def add_transactions(self):
 		import csv
 		db_session = get_db_session()
@@ -0,0 +1,301 @@
+import array
+import bisect
+import datetime
+from decimal import Decimal
+import json
+import logging
+import mmap
+import os
+import struct
+
+from database import get_db_session
+from models import Transaction, Account, Currency
+from records import TransactionRecord
+from sqlalchemy import select
+
+# Columnar, read only copy of a portfolio's transactions over a time range.
+#
+#   magic (8 bytes) | header length (uint32) | JSON header | padding
+#   one contiguous, 8 byte aligned array per column
+#   day index: first row of every day from the first day, plus the row count
+#
+# Accounts and currencies are uint8 positions in the lists the header names,
+# amounts are signed 16 byte little endian integers scaled by 10**AMOUNT_SCALE
+# (the scale of models.Amount, so decoded Decimals equal the database's) and
+# times are int64 microseconds since the epoch.
+MAGIC = b'LEDGER01'
+AMOUNT_SCALE = 12
+AMOUNT_BYTES = 16
+EPOCH = datetime.datetime(1970, 1, 1)
+ENUM_COLUMNS = ('from_account', 'from_currency', 'to_account', 'to_currency')
+AMOUNT_COLUMNS = ('from_amount', 'to_amount', 'usd_value', 'fee')
+
+def time2micros(time):
+	delta = time - EPOCH
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def micros2time(micros):
+	return EPOCH + datetime.timedelta(microseconds=micros)
+
+def amount2int(amount):
+	scaled = amount.scaleb(AMOUNT_SCALE)
+	if scaled != scaled.to_integral_value():
+		raise Exception('Amount %s has more than %d decimal places' %(amount, AMOUNT_SCALE))
+	return int(scaled)
+
+def int2amount(value):
+	return Decimal(value).scaleb(-AMOUNT_SCALE)
+
+def align(offset):
+	return (offset + 7) & ~7
+
+class LedgerFileWriter(object):
+	def __init__(self, name, start_time, end_time):
+		self._name = name
+		self._start_time = start_time
+		self._end_time = end_time
+		self._ids = array.array('q')
+		self._times = array.array('q')
+		self._enums = dict((column, bytearray()) for column in ENUM_COLUMNS)
+		self._amounts = dict((column, bytearray()) for column in AMOUNT_COLUMNS)
+		self._enum_index = {
+			'account': dict((member, i) for i, member in enumerate(Account)),
+			'currency': dict((member, i) for i, member in enumerate(Currency))
+		}
+		self._log = logging.getLogger('LedgerFileWriter')
+
+	def __len__(self):
+		return len(self._ids)
+
+	def append(self, record):
+		micros = time2micros(record.transacted_at)
+		if len(self._times) > 0 and micros < self._times[-1]:
+			raise Exception('Transactions must be appended in transacted_at order')
+		self._ids.append(record.id)
+		self._times.append(micros)
+		for column in ENUM_COLUMNS:
+			self._enums[column].append(self._enum_index[column.split('_')[1]][getattr(record, column)])
+		for column in AMOUNT_COLUMNS:
+			self._amounts[column] += amount2int(getattr(record, column)).to_bytes(AMOUNT_BYTES, 'little', signed=True)
+
+	def day_index(self):
+		first_day = self._start_time.date().toordinal()
+		num_days = self._end_time.date().toordinal() - first_day + 1
+		starts = array.array('q')
+		row = 0
+		for day in range(first_day, first_day + num_days):
+			day_start = time2micros(datetime.datetime.fromordinal(day))
+			row = bisect.bisect_left(self._times, day_start, row)
+			starts.append(row)
+		starts.append(len(self._times))
+		return first_day, starts
+
+	def write(self, filepath):
+		first_day, day_starts = self.day_index()
+		blocks = [
+			('id', 'q', self._ids.tobytes()),
+			('transacted_at', 'q', self._times.tobytes())
+		]
+		blocks += [(column, 'B', bytes(self._enums[column])) for column in ENUM_COLUMNS]
+		blocks += [(column, 'i128', bytes(self._amounts[column])) for column in AMOUNT_COLUMNS]
+		blocks.append(('day_index', 'q', day_starts.tobytes()))
+		header = {
+			'name': self._name,
+			'start_time': self._start_time.isoformat(),
+			'end_time': self._end_time.isoformat(),
+			'num_rows': len(self._ids),
+			'amount_scale': AMOUNT_SCALE,
+			'accounts': [member.name for member in Account],
+			'currencies': [member.name for member in Currency],
+			'first_day': first_day,
+			'columns': dict()
+		}
+		# Offsets depend on the header length, so lay out until it is stable
+		header_bytes = b''
+		while True:
+			offset = align(len(MAGIC) + 4 + len(header_bytes))
+			for column, kind, data in blocks:
+				header['columns'][column] = [offset, kind, len(data)]
+				offset = align(offset + len(data))
+			encoded = json.dumps(header, sort_keys=True).encode('utf8')
+			stable = len(encoded) == len(header_bytes)
+			# encoded holds the offsets just laid out, the previous pass may not
+			header_bytes = encoded
+			if stable:
+				break
+		tmp_filepath = filepath + '.tmp'
+		with open(tmp_filepath, 'wb') as outfile:
+			outfile.write(MAGIC)
+			outfile.write(struct.pack('<I', len(header_bytes)))
+			outfile.write(header_bytes)
+			for column, kind, data in blocks:
+				outfile.write(b'\0' * (header['columns'][column][0] - outfile.tell()))
+				outfile.write(data)
+		os.replace(tmp_filepath, filepath)
+		self._log.info('Wrote %d transactions to "%s"' %(len(self._ids), filepath))
+
+	@staticmethod
+	def export(name, start_time, end_time, filepath, batch_size=10000):
+		# Late import, accounting pulls in the engine and its snapshots
+		from accounting import CapFifoQueue
+		writer = LedgerFileWriter(name, start_time, end_time)
+		db_session = get_db_session()
+		try:
+			statement = select(*[getattr(Transaction, field) for field in TransactionRecord._fields])\
+				.where(*CapFifoQueue.portfolio_filters(name))\
+				.where(Transaction.transacted_at >= start_time)\
+				.where(Transaction.transacted_at < end_time)\
+				.order_by(Transaction.transacted_at.asc())
+			result = db_session.execute(
+				statement,
+				execution_options = {'stream_results': True})
+			for rows in result.partitions(batch_size):
+				for row in rows:
+					writer.append(TransactionRecord._make(row))
+		finally:
+			db_session.close()
+		writer.write(filepath)
+		return writer
+
+class LedgerFile(object):
+	# Reads a ledger file in place through mmap, decoding rows straight to
+	# TransactionRecord without a database or ORM objects
+	def __init__(self, filepath):
+		self._filepath = filepath
+		self._file = open(filepath, 'rb')
+		self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		if self._mmap[:len(MAGIC)] != MAGIC:
+			self.close()
+			raise Exception('"%s" is not a ledger file' %(filepath))
+		(header_length,) = struct.unpack_from('<I', self._mmap, len(MAGIC))
+		start = len(MAGIC) + 4
+		self._header = json.loads(self._mmap[start:start + header_length].decode('utf8'))
+		if self._header['amount_scale'] != AMOUNT_SCALE:
+			self.close()
+			raise Exception('Unsupported amount scale %d' %(self._header['amount_scale']))
+		self._name = self._header['name']
+		self._start_time = datetime.datetime.fromisoformat(self._header['start_time'])
+		self._end_time = datetime.datetime.fromisoformat(self._header['end_time'])
+		self._num_rows = self._header['num_rows']
+		self._accounts = [Account[name] for name in self._header['accounts']]
+		self._currencies = [Currency[name] for name in self._header['currencies']]
+		self._log = logging.getLogger('LedgerFile')
+
+	def __len__(self):
+		return self._num_rows
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		self._mmap.close()
+		self._file.close()
+
+	def column(self, name):
+		offset, kind, length = self._header['columns'][name]
+		view = memoryview(self._mmap)[offset:offset + length]
+		if kind == 'i128':
+			return view
+		return view.cast(kind)
+
+	def covers(self, start_time, end_time):
+		return self._start_time <= start_time and end_time <= self._end_time
+
+	def check(self, name, start_time, end_time):
+		# A report or validation from this file must see every row it would
+		# have read from the database
+		if self._name != name:
+			raise Exception('Ledger file is of "%s", not "%s"' %(self._name, name))
+		if not self.covers(start_time, end_time):
+			raise Exception('Ledger file covers %s to %s, not %s to %s' %(
+				self._start_time.isoformat(), self._end_time.isoformat(),
+				start_time.isoformat(), end_time.isoformat()))
+
+	def row_range(self, start_time=None, end_time=None):
+		# The day index narrows the search to one day, bisect finds the row
+		times = self.column('transacted_at')
+		day_index = self.column('day_index')
+		num_days = len(day_index) - 1
+		def find(time):
+			day = time.date().toordinal() - self._header['first_day']
+			if day < 0:
+				return 0
+			if day >= num_days:
+				return self._num_rows
+			return bisect.bisect_left(times, time2micros(time), day_index[day], day_index[day + 1])
+		try:
+			lo = 0 if start_time is None else find(start_time)
+			hi = self._num_rows if end_time is None else find(end_time)
+		finally:
+			times.release()
+			day_index.release()
+		return lo, hi
+
+	def records(self, start_time=None, end_time=None):
+		lo, hi = self.row_range(start_time, end_time)
+		ids = self.column('id')
+		times = self.column('transacted_at')
+		enums = dict((column, self.column(column)) for column in ENUM_COLUMNS)
+		amounts = dict((column, self.column(column)) for column in AMOUNT_COLUMNS)
+		accounts = self._accounts
+		currencies = self._currencies
+		def amount(column, row):
+			start = row * AMOUNT_BYTES
+			return int2amount(int.from_bytes(amounts[column][start:start + AMOUNT_BYTES], 'little', signed=True))
+		try:
+			for row in range(lo, hi):
+				yield TransactionRecord(
+					ids[row],
+					accounts[enums['from_account'][row]],
+					currencies[enums['from_currency'][row]],
+					amount('from_amount', row),
+					accounts[enums['to_account'][row]],
+					currencies[enums['to_currency'][row]],
+					amount('to_amount', row),
+					amount('usd_value', row),
+					amount('fee', row),
+					micros2time(times[row]))
+		finally:
+			# Views have to go before the mmap can close
+			for view in [ids, times] + list(enums.values()) + list(amounts.values()):
+				view.release()
+
+if __name__ == '__main__':
+
+	import optparse
+	parser = optparse.OptionParser(
+		usage='usage: %prog [options]',
+		version='%prog 1.0')
+	parser.add_option('-L', '--log-level',
+		default = 'INFO',
+		help = 'log level {DEBUG, INFO, WARNING, ERROR, CRITICAL}. [%default]')
+	parser.add_option('-t', '--type',
+		type=str,
+		help='Name of the account type {business, personal}')
+	parser.add_option('-s', '--start-time',
+		type=str,
+		help='String of datetime to start {2019-01-19T13:59:12.562Z}')
+	parser.add_option('-e', '--end-time',
+		type=str,
+		help='String of datetime to end {2019-01-19T13:59:12.562Z}')
+	parser.add_option('-o', '--output',
+		type=str,
+		help='Ledger file to write, defaults to data/<type>/ledger.<start>-<end>.bin')
+	(opts, args) = parser.parse_args()
+
+	from util import log_setup
+	log_setup.setupLogging(opts.log_level)
+	log = logging.getLogger('main')
+
+	DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+	start_time = datetime.datetime.strptime(opts.start_time, DATETIME_FORMAT)
+	end_time = datetime.datetime.strptime(opts.end_time, DATETIME_FORMAT)
+	filepath = opts.output or os.path.join('data', opts.type, 'ledger.%s-%s.bin' %(
+		start_time.strftime('%Y-%m-%dT%H-%M-%S.%f'),
+		end_time.strftime('%Y-%m-%dT%H-%M-%S.%f')))
+	writer = LedgerFileWriter.export(opts.type, start_time, end_time, filepath)
+	log.info('Exported %d transactions of "%s" to "%s" (%d bytes)' %(
+		len(writer), opts.type, filepath, os.path.getsize(filepath)))
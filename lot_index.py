@@ -0,0 +1,373 @@
+import bisect
+import datetime
+import heapq
+from decimal import Decimal
+import os
+import pickle
+
+LONG_TERM_PERIOD = datetime.timedelta(days=365)
+
+def lot_key(lot):
+	return (lot._currency, lot._transaction_id)
+
+class LotAgingIndex(object):
+	# Open lots across all wallets ordered by acquisition time. Consumed lots
+	# are deleted lazily and the sorted arrays are compacted once more than
+	# half of their entries are dead.
+	def __init__(self):
+		self._times = list()
+		self._keys = list()
+		self._lots = dict() # key -> [acquired_at, remaining_amount, unit_cost]
+		self._num_dead = 0
+
+	def __len__(self):
+		return len(self._lots)
+
+	def lot_opened(self, lot):
+		key = lot_key(lot)
+		if key in self._lots:
+			return
+		self._lots[key] = [lot._transacted_at, lot._remaining_amount, lot._price + lot._fee]
+		# Ledgers are processed in time order so this is almost always an append
+		if len(self._times) == 0 or lot._transacted_at >= self._times[-1]:
+			self._times.append(lot._transacted_at)
+			self._keys.append(key)
+		else:
+			index = bisect.bisect_right(self._times, lot._transacted_at)
+			self._times.insert(index, lot._transacted_at)
+			self._keys.insert(index, key)
+
+	def load_lots(self, lots):
+		# Lot books do not keep lots in acquisition order, so the
+		# whole set is sorted once instead of inserted lot by lot
+		for lot in lots:
+			key = lot_key(lot)
+			if key in self._lots:
+				continue
+			self._lots[key] = [lot._transacted_at, lot._remaining_amount, lot._price + lot._fee]
+		live = sorted(((entry[0], key) for key, entry in self._lots.items()), key=lambda item: item[0])
+		self._times = [t for t, k in live]
+		self._keys = [k for t, k in live]
+		self._num_dead = 0
+
+	def lot_relieved(self, lot, qty, time):
+		key = lot_key(lot)
+		entry = self._lots.get(key)
+		if entry is None:
+			return
+		entry[1] -= qty
+		if entry[1] <= 0:
+			del self._lots[key]
+			self._num_dead += 1
+			if self._num_dead > len(self._lots):
+				self._compact()
+
+	def _compact(self):
+		live = [(t, k) for t, k in zip(self._times, self._keys) if k in self._lots]
+		self._times = [t for t, k in live]
+		self._keys = [k for t, k in live]
+		self._num_dead = 0
+
+	def crossing_long_term(self, as_of, days):
+		# A lot is long term once as_of - acquired_at >= LONG_TERM_PERIOD, so the
+		# lots crossing within the horizon were acquired in (lo, hi]
+		lo_time = as_of - LONG_TERM_PERIOD
+		hi_time = lo_time + datetime.timedelta(days=days)
+		lo = bisect.bisect_right(self._times, lo_time)
+		hi = bisect.bisect_right(self._times, hi_time)
+		lots = list()
+		for index in range(lo, hi):
+			key = self._keys[index]
+			entry = self._lots.get(key)
+			if entry is None:
+				continue
+			acquired_at, remaining_amount, unit_cost = entry
+			lots.append({
+				'currency': key[0],
+				'transaction_id': key[1],
+				'acquired_at': acquired_at,
+				'long_term_at': acquired_at + LONG_TERM_PERIOD,
+				'remaining_qty': remaining_amount,
+				'cost_basis': remaining_amount * unit_cost
+			})
+		return lots
+
+class SortedChunks(object):
+	# Sorted list split into bounded chunks so inserts and removes shift one
+	# chunk instead of the whole list
+	CHUNK_SIZE = 1000
+
+	def __init__(self, items=()):
+		items = sorted(items)
+		self._chunks = [items[i:i + SortedChunks.CHUNK_SIZE] for i in range(0, len(items), SortedChunks.CHUNK_SIZE)]
+		self._maxes = [chunk[-1] for chunk in self._chunks]
+		self._len = len(items)
+
+	def __len__(self):
+		return self._len
+
+	def __iter__(self):
+		for chunk in self._chunks:
+			for item in chunk:
+				yield item
+
+	def add(self, item):
+		self._len += 1
+		if len(self._chunks) == 0:
+			self._chunks.append([item])
+			self._maxes.append(item)
+			return
+		index = min(bisect.bisect_left(self._maxes, item), len(self._chunks) - 1)
+		chunk = self._chunks[index]
+		bisect.insort(chunk, item)
+		self._maxes[index] = chunk[-1]
+		if len(chunk) > 2 * SortedChunks.CHUNK_SIZE:
+			self._chunks[index:index + 1] = [chunk[:SortedChunks.CHUNK_SIZE], chunk[SortedChunks.CHUNK_SIZE:]]
+			self._maxes[index:index + 1] = [chunk[SortedChunks.CHUNK_SIZE - 1], chunk[-1]]
+
+	def remove(self, item):
+		index = bisect.bisect_left(self._maxes, item)
+		if index == len(self._chunks):
+			return False
+		chunk = self._chunks[index]
+		position = bisect.bisect_left(chunk, item)
+		if position == len(chunk) or chunk[position] != item:
+			return False
+		del chunk[position]
+		self._len -= 1
+		if len(chunk) == 0:
+			del self._chunks[index]
+			del self._maxes[index]
+		else:
+			self._maxes[index] = chunk[-1]
+		return True
+
+class HarvestIndex(object):
+	# Open lots of every currency ordered by cost per coin, highest first,
+	# split into short and long term as of the last query. A heap on
+	# acquisition time moves lots to long term as queries move forward, so
+	# a query only reads the lots it returns.
+	def __init__(self, as_of=None):
+		self._lots = dict() # key -> [acquired_at, remaining_amount, unit_cost, seq, is_long_term]
+		self._short = dict() # currency -> SortedChunks of (-unit_cost, seq, key)
+		self._long = dict()
+		self._aging = list() # heap of (acquired_at, seq, key) still short term
+		self._as_of = as_of
+		self._seq = 0
+
+	def __len__(self):
+		return len(self._lots)
+
+	def lot(self, key):
+		return self._lots.get(key)
+
+	def _partition(self, currency, is_long_term):
+		partitions = self._long if is_long_term else self._short
+		if currency not in partitions:
+			partitions[currency] = SortedChunks()
+		return partitions[currency]
+
+	def _is_long_term(self, acquired_at):
+		return self._as_of is not None and self._as_of - acquired_at >= LONG_TERM_PERIOD
+
+	def load_lots(self, lots):
+		for lot in lots:
+			key = lot_key(lot)
+			if key in self._lots:
+				continue
+			self._lots[key] = [lot._transacted_at, lot._remaining_amount, lot._price + lot._fee, self._seq, False]
+			self._seq += 1
+		self._partition_all()
+
+	def _partition_all(self):
+		# One sort per partition rather than an insert per lot
+		partitions = dict()
+		self._aging = list()
+		for key, entry in self._lots.items():
+			acquired_at, remaining_amount, unit_cost, seq, is_long_term = entry
+			entry[4] = self._is_long_term(acquired_at)
+			partitions.setdefault((key[0], entry[4]), list()).append((-unit_cost, seq, key))
+			if not entry[4]:
+				self._aging.append((acquired_at, seq, key))
+		self._short = dict()
+		self._long = dict()
+		for (currency, is_long_term), items in partitions.items():
+			(self._long if is_long_term else self._short)[currency] = SortedChunks(items)
+		heapq.heapify(self._aging)
+
+	def lot_opened(self, lot):
+		key = lot_key(lot)
+		if key in self._lots:
+			return
+		unit_cost = lot._price + lot._fee
+		is_long_term = self._is_long_term(lot._transacted_at)
+		self._lots[key] = [lot._transacted_at, lot._remaining_amount, unit_cost, self._seq, is_long_term]
+		self._partition(lot._currency, is_long_term).add((-unit_cost, self._seq, key))
+		if not is_long_term:
+			heapq.heappush(self._aging, (lot._transacted_at, self._seq, key))
+		self._seq += 1
+
+	def lot_relieved(self, lot, qty, time):
+		key = lot_key(lot)
+		entry = self._lots.get(key)
+		if entry is None:
+			return
+		entry[1] -= qty
+		if entry[1] <= 0:
+			acquired_at, remaining_amount, unit_cost, seq, is_long_term = entry
+			self._partition(key[0], is_long_term).remove((-unit_cost, seq, key))
+			del self._lots[key]
+
+	def _age(self, as_of):
+		if self._as_of is not None and as_of < self._as_of:
+			# Going back in time, partition everything again
+			self._as_of = as_of
+			self._partition_all()
+			return
+		self._as_of = as_of
+		while len(self._aging) > 0 and self._is_long_term(self._aging[0][0]):
+			acquired_at, seq, key = heapq.heappop(self._aging)
+			entry = self._lots.get(key)
+			if entry is None or entry[3] != seq:
+				continue
+			self._partition(key[0], False).remove((-entry[2], seq, key))
+			self._partition(key[0], True).add((-entry[2], seq, key))
+			entry[4] = True
+
+	def candidates(self, prices, as_of):
+		# Lots priced above prices[currency], short term first, then by loss
+		# as a fraction of cost basis, largest first. Yields (ratio, seq, key).
+		self._age(as_of)
+		def stream(partition, price):
+			for negative_cost, seq, key in partition:
+				if -negative_cost <= price:
+					return
+				yield ((price + negative_cost) / -negative_cost, seq, key)
+		for partitions in (self._short, self._long):
+			streams = [stream(partitions[currency], price)
+				for currency, price in prices.items() if currency in partitions]
+			for candidate in heapq.merge(*streams):
+				yield candidate
+
+class LotLifetimeIndex(object):
+	# Every lot with its acquisition time and the times its remaining amount
+	# dropped, plus per currency step functions of held quantity and cost
+	# basis so holdings at any time are a bisect into prefix sums
+	def __init__(self, valid_from):
+		self._valid_from = valid_from
+		self._lots = dict() # key -> [acquired_at, unit_cost, [(time, remaining_amount)]]
+		self._steps = dict() # currency -> [(time, qty_delta, cost_delta)]
+		self._prefix = dict() # currency -> (times, qtys, costs), built on query
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['_prefix'] = dict()
+		return state
+
+	def _add_step(self, currency, time, qty, cost):
+		if currency not in self._steps:
+			self._steps[currency] = list()
+		self._steps[currency].append((time, qty, cost))
+		self._prefix.pop(currency, None)
+
+	def lot_opened(self, lot):
+		key = lot_key(lot)
+		if key in self._lots:
+			return
+		unit_cost = lot._price + lot._fee
+		self._lots[key] = [lot._transacted_at, unit_cost, [(lot._transacted_at, lot._remaining_amount)]]
+		self._add_step(lot._currency, lot._transacted_at, lot._remaining_amount, lot._remaining_amount * unit_cost)
+
+	def lot_relieved(self, lot, qty, time):
+		entry = self._lots.get(lot_key(lot))
+		if entry is None:
+			return
+		acquired_at, unit_cost, lifetime = entry
+		lifetime.append((time, lifetime[-1][1] - qty))
+		self._add_step(lot._currency, time, -qty, -qty * unit_cost)
+
+	def _build_prefix(self, currency):
+		steps = sorted(self._steps[currency], key=lambda step: step[0])
+		times = [step[0] for step in steps]
+		qtys = list()
+		costs = list()
+		qty = Decimal(0)
+		cost = Decimal(0)
+		for time, qty_delta, cost_delta in steps:
+			qty += qty_delta
+			cost += cost_delta
+			qtys.append(qty)
+			costs.append(cost)
+		self._prefix[currency] = (times, qtys, costs)
+		return self._prefix[currency]
+
+	def _check_time(self, time):
+		if time < self._valid_from:
+			raise Exception('Lot lifetimes are only indexed from %s' %(self._valid_from.isoformat()))
+
+	def holdings_at(self, time):
+		self._check_time(time)
+		holdings = dict()
+		for currency in self._steps:
+			prefix = self._prefix.get(currency) or self._build_prefix(currency)
+			times, qtys, costs = prefix
+			index = bisect.bisect_right(times, time)
+			if index == 0:
+				continue
+			holdings[currency] = {
+				'qty': qtys[index - 1],
+				'cost_basis': costs[index - 1]
+			}
+		return holdings
+
+	def lot_remaining_at(self, currency, transaction_id, time):
+		self._check_time(time)
+		entry = self._lots.get((currency, transaction_id))
+		if entry is None:
+			raise Exception('No lot for transaction_id=%d' %(transaction_id))
+		lifetime = entry[2]
+		index = bisect.bisect_right([t for t, remaining in lifetime], time)
+		if index == 0:
+			return Decimal(0)
+		return lifetime[index - 1][1]
+
+	def save(self, filepath):
+		with open(filepath, 'wb') as pickle_file:
+			pickle.dump(self, pickle_file)
+
+	@staticmethod
+	def load(filepath):
+		if not os.path.exists(filepath):
+			raise Exception('No lot lifetime index exists at "%s"' %(filepath))
+		with open(filepath, 'rb') as pickle_file:
+			return pickle.load(pickle_file)
+
+if __name__ == '__main__':
+
+	import optparse
+	parser = optparse.OptionParser(
+		usage='usage: %prog [options]',
+		version='%prog 1.0')
+	parser.add_option('-t', '--type',
+		type=str,
+		help='Name of the account type {business, personal}')
+	parser.add_option('-c', '--checkpoint-time',
+		type=str,
+		help='String of datetime of the checkpoint whose index to load {2019-01-19T13:59:12.562Z}')
+	parser.add_option('-a', '--at-time',
+		type=str,
+		help='String of datetime to report holdings at {2019-01-19T13:59:12.562Z}')
+	(opts, args) = parser.parse_args()
+
+	import json
+	from accounting import Portfolio
+	from models import CURRENCIES
+
+	DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+	checkpoint_time = datetime.datetime.strptime(opts.checkpoint_time, DATETIME_FORMAT)
+	at_time = datetime.datetime.strptime(opts.at_time, DATETIME_FORMAT)
+	index = LotLifetimeIndex.load(Portfolio.checkpoint_path(opts.type, checkpoint_time, 'lifetimes'))
+	holdings = index.holdings_at(at_time)
+	print(json.dumps(dict(
+		(CURRENCIES[currency.value], {'qty': float(h['qty']), 'cost_basis': float(h['cost_basis'])})
+		for currency, h in holdings.items()), indent=2, sort_keys=True))
@@ -0,0 +1,243 @@
+from collections import deque
+from decimal import Decimal
+import fcntl
+import heapq
+import os
+import pickle
+
+class LotBook(object):
+	# Open lots of one wallet in the order a lot selection method relieves
+	# them
+	def __init__(self):
+		self._num_lots = 0
+
+	def __len__(self):
+		return self._num_lots
+
+	def __iter__(self):
+		for lot in self._iter_lots():
+			if lot._remaining_amount > 0:
+				yield lot
+
+	def unordered(self):
+		# Every open lot in storage order, for full scans that do not need
+		# relief order
+		for lot in self._iter_stored():
+			if lot._remaining_amount > 0:
+				yield lot
+
+	def _iter_stored(self):
+		return self._iter_lots()
+
+	def append(self, lot):
+		self._push(lot)
+		self._num_lots += 1
+
+	def head(self):
+		return self._peek()
+
+	def unit_cost(self, lot):
+		# (price, fee) per coin used as the cost basis when relieving lot
+		return lot._price, lot._fee
+
+	def relieve(self, lot, qty):
+		lot._remaining_amount -= qty
+		if lot._remaining_amount == 0:
+			self._pop()
+			self._num_lots -= 1
+
+	def preview(self, qty):
+		# The (lot, qty, price, fee) a sale of qty would relieve, book untouched
+		matches = list()
+		for lot in self:
+			if qty <= 0:
+				break
+			match_amount = min(lot._remaining_amount, qty)
+			price, fee = self.unit_cost(lot)
+			matches.append((lot, match_amount, price, fee))
+			qty -= match_amount
+		return matches
+
+	def cost_totals(self):
+		outstanding_qty = Decimal(0.0)
+		total_cost = Decimal(0.0)
+		for lot in self.unordered():
+			outstanding_qty += lot._remaining_amount
+			total_cost += lot._remaining_amount * lot._price
+		return outstanding_qty, total_cost
+
+class FifoLots(LotBook):
+	def __init__(self):
+		super(FifoLots, self).__init__()
+		self._lots = deque()
+
+	def _iter_lots(self):
+		return iter(self._lots)
+
+	def _push(self, lot):
+		self._lots.append(lot)
+
+	def _peek(self):
+		return self._lots[0] if len(self._lots) > 0 else None
+
+	def _pop(self):
+		self._lots.popleft()
+
+class LifoLots(LotBook):
+	def __init__(self):
+		super(LifoLots, self).__init__()
+		self._lots = list()
+
+	def _iter_lots(self):
+		return reversed(self._lots)
+
+	def _push(self, lot):
+		self._lots.append(lot)
+
+	def _peek(self):
+		return self._lots[-1] if len(self._lots) > 0 else None
+
+	def _pop(self):
+		self._lots.pop()
+
+class HifoLots(LotBook):
+	# Heap keyed on cost per coin, highest first, ties by acquisition order
+	def __init__(self):
+		super(HifoLots, self).__init__()
+		self._heap = list()
+		self._seq = 0
+
+	def _iter_lots(self):
+		# Pops from a copy so a partial scan does not sort the whole heap
+		heap = list(self._heap)
+		while len(heap) > 0:
+			yield heapq.heappop(heap)[2]
+
+	def _iter_stored(self):
+		return (entry[2] for entry in self._heap)
+
+	def _push(self, lot):
+		heapq.heappush(self._heap, (-(lot._price + lot._fee), self._seq, lot))
+		self._seq += 1
+
+	def _peek(self):
+		return self._heap[0][2] if len(self._heap) > 0 else None
+
+	def _pop(self):
+		heapq.heappop(self._heap)
+
+class AverageCostLots(FifoLots):
+	# Lots keep FIFO order for holding periods and transaction ids while the
+	# cost basis comes from the running average of the whole pool
+	def __init__(self):
+		super(AverageCostLots, self).__init__()
+		self._total_qty = Decimal(0.0)
+		self._total_price = Decimal(0.0)
+		self._total_fee = Decimal(0.0)
+
+	def append(self, lot):
+		super(AverageCostLots, self).append(lot)
+		self._total_qty += lot._remaining_amount
+		self._total_price += lot._remaining_amount * lot._price
+		self._total_fee += lot._remaining_amount * lot._fee
+
+	def unit_cost(self, lot):
+		return self._total_price / self._total_qty, self._total_fee / self._total_qty
+
+	def relieve(self, lot, qty):
+		price, fee = self.unit_cost(lot)
+		self._total_qty -= qty
+		self._total_price -= qty * price
+		self._total_fee -= qty * fee
+		if self._total_qty == 0:
+			# Drop rounding residue once the pool is empty
+			self._total_price = Decimal(0.0)
+			self._total_fee = Decimal(0.0)
+		super(AverageCostLots, self).relieve(lot, qty)
+
+	def cost_totals(self):
+		return self._total_qty, self._total_price
+
+class SpillingFifoLots(LotBook):
+	# FIFO only ever relieves from the front, so just a head window is kept
+	# in memory. Newer lots collect in a tail buffer that is appended as one
+	# chunk to an append-only spill file once full. Chunks are never
+	# rewritten, so older snapshots of the book stay readable, and they are
+	# paged back in one at a time as the head runs out.
+	def __init__(self, spill_path, head_size=10000, segment_size=10000):
+		super(SpillingFifoLots, self).__init__()
+		self._spill_path = spill_path
+		self._head_size = head_size
+		self._segment_size = segment_size
+		self._head = deque()
+		self._segments = deque() # (offset, length) of chunks in the spill file
+		self._tail = list()
+
+	def _write_segment(self, lots):
+		directory = os.path.dirname(self._spill_path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		data = pickle.dumps(lots, pickle.HIGHEST_PROTOCOL)
+		with open(self._spill_path, 'ab') as spill_file:
+			# Other processes append to the same file, the end offset is only
+			# ours while the lock is held
+			fcntl.flock(spill_file, fcntl.LOCK_EX)
+			try:
+				offset = spill_file.seek(0, os.SEEK_END)
+				spill_file.write(data)
+				spill_file.flush()
+			finally:
+				fcntl.flock(spill_file, fcntl.LOCK_UN)
+		self._segments.append((offset, len(data)))
+
+	def _read_segment(self, segment):
+		offset, length = segment
+		with open(self._spill_path, 'rb') as spill_file:
+			spill_file.seek(offset)
+			return pickle.loads(spill_file.read(length))
+
+	def _iter_lots(self):
+		for lot in self._head:
+			yield lot
+		for segment in self._segments:
+			for lot in self._read_segment(segment):
+				yield lot
+		for lot in self._tail:
+			yield lot
+
+	def _push(self, lot):
+		if len(self._segments) == 0 and len(self._tail) == 0 and len(self._head) < self._head_size:
+			self._head.append(lot)
+			return
+		self._tail.append(lot)
+		if len(self._tail) >= self._segment_size:
+			self._write_segment(self._tail)
+			self._tail = list()
+
+	def _peek(self):
+		if len(self._head) == 0:
+			if len(self._segments) > 0:
+				self._head = deque(self._read_segment(self._segments.popleft()))
+			elif len(self._tail) > 0:
+				self._head = deque(self._tail)
+				self._tail = list()
+		return self._head[0] if len(self._head) > 0 else None
+
+	def _pop(self):
+		self._head.popleft()
+
+LOT_METHODS = {
+	'fifo': FifoLots,
+	'lifo': LifoLots,
+	'hifo': HifoLots,
+	'average': AverageCostLots,
+	'fifo_spill': SpillingFifoLots,
+}
+
+def make_lot_book(lot_method, lots=(), **options):
+	if lot_method not in LOT_METHODS:
+		raise Exception('Unrecognized lot method "%s"' %(lot_method))
+	book = LOT_METHODS[lot_method](**options)
+	for lot in lots:
+		book.append(lot)
+	return book
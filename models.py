@@ -126,3 +126,61 @@ class Pagination(Base):
 		record += "  cursor_after: %s\n" %(self.cursor_after)
 		record += "]\n"
 		return record
+
+class StagedFill(Base):
+	__tablename__ = 'staged_fills'
+
+	id = Column(Integer, primary_key=True, nullable=False)
+	account = Column(Enum(Account), nullable=False)
+	external_id = Column(String, unique=True, nullable=False) # <trade_id>:<order_id>
+	product_id = Column(String, nullable=False)
+	side = Column(String, nullable=False)
+	size = Column(Amount, nullable=False)
+	price = Column(Amount, nullable=False)
+	fee = Column(Amount, nullable=False)
+	usd_volume = Column(Amount, nullable=True)
+	created_at = Column(DateTime, index=True, nullable=False)
+	staged_at = Column(DateTime, server_default=utcnow())
+	promoted_at = Column(DateTime, index=True, nullable=True)
+
+	def __str__(self):
+		return self.__repr__()
+
+	def __repr__(self):
+		record = "\n[StagedFill\n"
+		record += "  id: %s\n" %(self.id or '(unknown)')
+		record += "  account: %s\n" %(self.account)
+		record += "  external_id: %s\n" %(self.external_id)
+		record += "  product_id: %s\n" %(self.product_id)
+		record += "  side: %s\n" %(self.side)
+		record += "  size: %1.12f\n" %(self.size)
+		record += "  price: %1.12f\n" %(self.price)
+		record += "  fee: %1.12f\n" %(self.fee)
+		record += "  usd_volume: %s\n" %(self.usd_volume)
+		record += "  created_at: %s\n" %(self.created_at)
+		record += "  staged_at: %s\n" %(self.staged_at)
+		record += "  promoted_at: %s\n" %(self.promoted_at)
+		record += "]\n"
+		return record
+
+class LedgerChange(Base):
+	__tablename__ = 'ledger_changes'
+
+	id = Column(Integer, primary_key=True, nullable=False)
+	transaction_id = Column(Integer, index=True, nullable=False)
+	currency = Column(Enum(Currency), nullable=False)
+	transacted_at = Column(DateTime, nullable=False) # earliest time the change affects
+	recorded_at = Column(DateTime, server_default=utcnow())
+
+	def __str__(self):
+		return self.__repr__()
+
+	def __repr__(self):
+		record = "\n[LedgerChange\n"
+		record += "  id: %s\n" %(self.id or '(unknown)')
+		record += "  transaction_id: %s\n" %(self.transaction_id)
+		record += "  currency: %s\n" %(self.currency)
+		record += "  transacted_at: %s\n" %(self.transacted_at)
+		record += "  recorded_at: %s\n" %(self.recorded_at)
+		record += "]\n"
+		return record
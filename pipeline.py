@@ -0,0 +1,95 @@
+import queue
+import threading
+
+class _Done(object):
+	pass
+
+class _Failure(object):
+	def __init__(self, exception):
+		self._exception = exception
+
+class Pipeline(object):
+	# Runs a source of batches and each transform stage in its own thread,
+	# connected by bounded queues. Iterating yields the items of the batches
+	# coming out of the last stage. An exception in any stage is re-raised
+	# in the consuming thread and stops the other stages.
+	def __init__(self, source, stages=(), maxsize=4, timeout=0.1):
+		self._source = source
+		self._stages = list(stages)
+		self._maxsize = maxsize
+		self._timeout = timeout
+		self._stop = threading.Event()
+
+	def _put(self, out_queue, item):
+		while not self._stop.is_set():
+			try:
+				out_queue.put(item, timeout=self._timeout)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	def _get(self, in_queue):
+		while True:
+			try:
+				return in_queue.get(timeout=self._timeout)
+			except queue.Empty:
+				if self._stop.is_set():
+					return _Done()
+
+	def _run_source(self, out_queue):
+		batches = self._source()
+		try:
+			for batch in batches:
+				if not self._put(out_queue, batch):
+					return
+			self._put(out_queue, _Done())
+		except Exception as e:
+			self._put(out_queue, _Failure(e))
+		finally:
+			# Lets a generator source release its resources in this thread
+			if hasattr(batches, 'close'):
+				batches.close()
+
+	def _run_stage(self, stage, in_queue, out_queue):
+		while True:
+			batch = self._get(in_queue)
+			if isinstance(batch, (_Done, _Failure)):
+				self._put(out_queue, batch)
+				return
+			try:
+				batch = stage(batch)
+			except Exception as e:
+				self._put(out_queue, _Failure(e))
+				return
+			if not self._put(out_queue, batch):
+				return
+
+	def __iter__(self):
+		queues = [queue.Queue(maxsize=self._maxsize) for i in range(len(self._stages) + 1)]
+		threads = [threading.Thread(
+			target = self._run_source,
+			args = (queues[0],),
+			name = 'pipeline-source',
+			daemon = True)]
+		for index, stage in enumerate(self._stages):
+			threads.append(threading.Thread(
+				target = self._run_stage,
+				args = (stage, queues[index], queues[index + 1]),
+				name = 'pipeline-stage-%d' %(index),
+				daemon = True))
+		for thread in threads:
+			thread.start()
+		try:
+			while True:
+				batch = self._get(queues[-1])
+				if isinstance(batch, _Done):
+					return
+				if isinstance(batch, _Failure):
+					raise batch._exception
+				for item in batch:
+					yield item
+		finally:
+			self._stop.set()
+			for thread in threads:
+				thread.join()
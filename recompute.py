@@ -0,0 +1,122 @@
+import copy
+import logging
+import os
+
+from accounting import Portfolio, CapFifoQueue
+from changes import ChangeTracker
+from database import get_db_session
+from models import Transaction
+from records import TransactionRecord
+from sqlalchemy import or_
+
+class BackdateRecompute(object):
+	# Absorbs new or corrected transactions that land before the latest
+	# snapshot. Wallets never read each other, so only the wallets of the
+	# affected currencies are replayed, from the newest snapshot at or before
+	# the earliest change, and patched into every later snapshot.
+	def __init__(self, name):
+		self._name = name
+		self._tracker = ChangeTracker(name)
+		self._log = logging.getLogger('BackdateRecompute')
+
+	def run(self):
+		db_session = get_db_session()
+		try:
+			affected, watermark = self._tracker.pending(
+				db_session,
+				CapFifoQueue.portfolio_filters(self._name))
+			if len(affected) > 0:
+				self.recompute(db_session, affected)
+			self._tracker.save_watermark(watermark)
+			return affected
+		finally:
+			db_session.close()
+
+	def recompute(self, db_session, affected):
+		checkpoints = Portfolio.checkpoint_times(self._name)
+		earliest = min(affected.values())
+		later = [time for time in checkpoints if time > earliest]
+		if len(later) == 0:
+			# Nothing snapshotted past the change, the next report picks it up
+			self._log.info('No snapshots after %s, nothing to recompute' %(earliest.isoformat()))
+			return
+		valid = [time for time in checkpoints if time <= earliest]
+		if len(valid) == 0:
+			raise Exception('No snapshot of "%s" at or before %s' %(self._name, earliest.isoformat()))
+		currencies = set(affected.keys())
+		base = Portfolio.load(self._name, valid[-1])
+		self._log.info('Replaying %s from %s through %d snapshots' %(
+			', '.join(currency.name for currency in currencies),
+			base._time.isoformat(),
+			len(later)))
+		replay = Portfolio(self._name, base._time, base._lot_method)
+		for currency in currencies:
+			if currency in base._wallets:
+				replay._wallets[currency] = base._wallets[currency]
+				replay._wallets[currency]._observers = replay._lot_observers
+		rows = db_session.query(*[getattr(Transaction, field) for field in TransactionRecord._fields])\
+			.filter(*CapFifoQueue.portfolio_filters(self._name))\
+			.filter(or_(
+				Transaction.from_currency.in_(currencies),
+				Transaction.to_currency.in_(currencies)))\
+			.filter(Transaction.transacted_at >= base._time)\
+			.filter(Transaction.transacted_at < later[-1])\
+			.order_by(Transaction.transacted_at.asc())
+		num_replayed = 0
+		for record in map(TransactionRecord._make, rows):
+			# A snapshot at time t holds everything transacted before t
+			while len(later) > 0 and record.transacted_at >= later[0]:
+				self.patch(later.pop(0), replay, currencies)
+			replay.process(record, currencies)
+			num_replayed += 1
+		for time in later:
+			self.patch(time, replay, currencies)
+		self._log.info('Replayed %d transactions' %(num_replayed))
+		self.invalidate_reports(earliest)
+
+	def patch(self, time, replay, currencies):
+		snapshot = Portfolio.load(self._name, time)
+		for currency in currencies:
+			if currency in replay._wallets:
+				snapshot._wallets[currency] = copy.deepcopy(replay._wallets[currency])
+			else:
+				snapshot._wallets.pop(currency, None)
+		snapshot.save()
+		self._log.info('Patched snapshot at %s' %(time.isoformat()))
+
+	def invalidate_reports(self, earliest):
+		# Reports and lifetime indexes covering the change are now stale
+		account_dir = os.path.join('data', self._name)
+		for filename in os.listdir(account_dir):
+			if filename.startswith('lifetimes.') and filename.endswith('.pkl'):
+				end = Portfolio.file2time(filename.replace('lifetimes.', 'portfolio.', 1))
+			elif (filename.startswith('capgains.') or filename.startswith('simulation.')) and filename.endswith('.json'):
+				end = Portfolio.file2time('portfolio.%s.pkl' %(filename[:-5].split('-')[-1]))
+			else:
+				continue
+			if end > earliest:
+				filepath = os.path.join(account_dir, filename)
+				os.replace(filepath, filepath + '.stale')
+				self._log.info('Invalidated "%s"' %(filename))
+
+if __name__ == '__main__':
+
+	import optparse
+	parser = optparse.OptionParser(
+		usage='usage: %prog [options]',
+		version='%prog 1.0')
+	parser.add_option('-L', '--log-level',
+		default = 'INFO',
+		help = 'log level {DEBUG, INFO, WARNING, ERROR, CRITICAL}. [%default]')
+	parser.add_option('-t', '--type',
+		type=str,
+		help='Name of the account type {business, personal}')
+	(opts, args) = parser.parse_args()
+
+	from util import log_setup
+	log_setup.setupLogging(opts.log_level)
+	log = logging.getLogger('main')
+
+	affected = BackdateRecompute(opts.type).run()
+	for currency, transacted_at in affected.items():
+		log.info('%s affected from %s' %(currency.name, transacted_at.isoformat()))
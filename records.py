@@ -0,0 +1,15 @@
+from collections import namedtuple
+
+# Decoded view of a transactions row with just what the engine reads
+TransactionRecord = namedtuple('TransactionRecord', (
+	'id',
+	'from_account',
+	'from_currency',
+	'from_amount',
+	'to_account',
+	'to_currency',
+	'to_amount',
+	'usd_value',
+	'fee',
+	'transacted_at',
+))
@@ -0,0 +1,401 @@
+import datetime
+from decimal import Decimal
+import enum
+import json
+import logging
+import os
+import select
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from accounting import Portfolio, CapFifoQueue, CapGains
+from changes import ChangeTracker, NOTIFY_CHANNEL
+from database import get_db_session, get_engine
+from gains_aggregation import GainsColumns
+from models import Transaction, LedgerChange, Currency, CURRENCIES
+from records import TransactionRecord
+
+# Rows can commit slightly out of ingested_at order, so every poll looks
+# back this far and skips the ids it has already applied
+INGEST_OVERLAP = datetime.timedelta(minutes=5)
+
+RECORD_COLUMNS = [getattr(Transaction, field) for field in TransactionRecord._fields]
+
+class WarmPortfolio(object):
+	# Newest snapshot of one portfolio kept in memory and rolled forward with
+	# every transaction ingested since, along with its realized gains
+	def __init__(self, name):
+		self._name = name
+		self._tracker = ChangeTracker(name)
+		self._stale_from = None
+		self._stale_watermark = None
+		self._lock = threading.RLock()
+		self._log = logging.getLogger('WarmPortfolio')
+
+	def load(self, db_session, before=None):
+		# Snapshots past a change recompute.py has not absorbed yet still hold
+		# the old rows, so start from the newest one at or before it. Changes
+		# seen here count until recompute.py's watermark passes them.
+		affected, watermark = self._tracker.pending(
+			db_session,
+			CapFifoQueue.portfolio_filters(self._name))
+		if self._stale_from is not None and self._tracker.absorbed(self._stale_watermark):
+			self._stale_from = None
+		if before is not None:
+			self._stale_from = before if self._stale_from is None else min(self._stale_from, before)
+			self._stale_watermark = watermark
+		times = list(affected.values()) + ([self._stale_from] if self._stale_from is not None else [])
+		checkpoints = Portfolio.checkpoint_times(self._name)
+		if len(times) > 0:
+			checkpoints = [time for time in checkpoints if time <= min(times)]
+		if len(checkpoints) == 0:
+			raise Exception('No snapshots of "%s" to start from' %(self._name))
+		portfolio = Portfolio.load(self._name, checkpoints[-1])
+		transactions = self.fetch(db_session, Transaction.transacted_at >= portfolio._time)
+		with self._lock:
+			self._portfolio = portfolio
+			self._since = portfolio._time
+			self._gains = GainsColumns()
+			self._recent = dict()
+			self._last_change_id = watermark['last_change_id']
+			self._ingested_at = watermark['ingested_at'] or datetime.datetime(1970, 1, 1)
+			self._num_applied = 0
+			self.apply(transactions)
+			# Rows in the overlap window are already in the snapshot or applied,
+			# as they stand now, so is_current can vouch for them
+			for record, ingested_at in self.fetch(db_session, Transaction.ingested_at > self._ingested_at - INGEST_OVERLAP):
+				self._recent.setdefault(record.id, (ingested_at, record))
+		self._log.info('Loaded "%s" from %s, applied %d transactions' %(
+			self._name, self._since.isoformat(), self._num_applied))
+
+	def fetch(self, db_session, *filters):
+		# (record, ingested_at) of the portfolio's rows in transacted_at order,
+		# selected as plain columns so rows become records once, here
+		rows = db_session.query(*RECORD_COLUMNS, Transaction.ingested_at)\
+			.filter(*CapFifoQueue.portfolio_filters(self._name))\
+			.filter(*filters)\
+			.order_by(Transaction.transacted_at.asc())
+		return [(TransactionRecord._make(row[:-1]), row[-1]) for row in rows]
+
+	def apply(self, transactions):
+		for record, ingested_at in transactions:
+			if record.id in self._recent:
+				continue
+			self._gains.add_events(self._portfolio.process(record))
+			self._recent[record.id] = (ingested_at, record)
+			self._num_applied += 1
+
+	def is_current(self, db_session, transaction_id):
+		# Whether the row as it stands now is what was applied in memory
+		applied = self._recent.get(transaction_id)
+		if applied is None:
+			return False
+		row = db_session.query(*RECORD_COLUMNS)\
+			.filter(Transaction.id == transaction_id)\
+			.one_or_none()
+		return row is not None and TransactionRecord._make(row) == applied[1]
+
+	def refresh(self, db_session):
+		# Corrections rewrite rows in place, so ledger_changes is checked for
+		# anything landing behind the wallets before applying new rows
+		changes = db_session.query(LedgerChange.id, LedgerChange.transaction_id, LedgerChange.transacted_at)\
+			.join(Transaction, Transaction.id == LedgerChange.transaction_id)\
+			.filter(*CapFifoQueue.portfolio_filters(self._name))\
+			.filter(LedgerChange.id > self._last_change_id)\
+			.all()
+		transactions = self.fetch(db_session, Transaction.ingested_at > self._ingested_at - INGEST_OVERLAP)
+		new = [(record, ingested_at) for record, ingested_at in transactions if record.id not in self._recent]
+		# An update leaves ingested_at alone, so a correction to the latest
+		# applied row only shows up here
+		backdated = [change for change in changes
+			if change.transacted_at <= self._portfolio._time and not self.is_current(db_session, change.transaction_id)]
+		if len(new) > 0 and new[0][0].transacted_at < self._portfolio._time:
+			backdated.append(new[0][0])
+		if len(backdated) > 0:
+			# The wallets already moved past the change, rebuild from a snapshot before it
+			self._log.info('%d backdated changes for "%s", reloading' %(len(backdated), self._name))
+			self.load(db_session, min(change.transacted_at for change in backdated))
+			return len(new) + len(changes)
+		with self._lock:
+			self.apply(new)
+			if len(changes) > 0:
+				self._last_change_id = max(change.id for change in changes)
+			if len(new) > 0:
+				self._ingested_at = max(self._ingested_at, max(ingested_at for record, ingested_at in new))
+			cutoff = self._ingested_at - INGEST_OVERLAP
+			self._recent = dict(
+				(transaction_id, applied) for transaction_id, applied in self._recent.items()
+				if applied[0] is not None and applied[0] > cutoff)
+		return len(new)
+
+	def report(self, breakdowns=(), mark=False):
+		with self._lock:
+			report = {
+				'name': self._name,
+				'since': self._since.isoformat(),
+				'time': self._portfolio._time.isoformat(),
+				'num_txns_applied': self._num_applied,
+				'short_term': CapGains.term_summary(self._gains, 'short'),
+				'long_term': CapGains.term_summary(self._gains, 'long'),
+				'breakdowns': dict(
+					(','.join(dimensions), self._gains.group_by(dimensions))
+				for dimensions in breakdowns)
+			}
+			if mark:
+				report['unrealized_gains'] = self._portfolio.mark()
+			return report
+
+	def holdings(self):
+		with self._lock:
+			holdings = dict()
+			for currency, wallet in self._portfolio._wallets.items():
+				outstanding_qty, avg_cost = wallet.metrics()
+				holdings[currency] = {
+					'outstanding_qty': outstanding_qty,
+					'avg_cost': avg_cost,
+					'num_lots': len(wallet._open_txns)
+				}
+			return {
+				'name': self._name,
+				'time': self._portfolio._time.isoformat(),
+				'wallets': holdings
+			}
+
+	def aging(self, days):
+		with self._lock:
+			return {
+				'name': self._name,
+				'time': self._portfolio._time.isoformat(),
+				'lots': self._portfolio.lots_turning_long_term(days)
+			}
+
+	def harvest(self, prices, target_loss):
+		with self._lock:
+			return self._portfolio.plan_harvest(prices, target_loss)
+
+class PgNotifyListener(object):
+	# Wakes the service as soon as an ingester commits, see changes.record_changes
+	def __init__(self, wake):
+		self._wake = wake
+		self._stop = threading.Event()
+		self._log = logging.getLogger('PgNotifyListener')
+
+	def run(self):
+		connection = get_engine().raw_connection()
+		try:
+			connection.connection.set_isolation_level(0) # autocommit
+			cursor = connection.cursor()
+			cursor.execute('LISTEN %s' %(NOTIFY_CHANNEL))
+			while not self._stop.is_set():
+				if select.select([connection.connection], [], [], 1.0) == ([], [], []):
+					continue
+				connection.connection.poll()
+				if len(connection.connection.notifies) > 0:
+					del connection.connection.notifies[:]
+					self._wake.set()
+		finally:
+			connection.close()
+
+	def stop(self):
+		self._stop.set()
+
+class PortfolioService(object):
+	def __init__(self, names, poll_interval=30.0):
+		self._portfolios = dict((name, WarmPortfolio(name)) for name in names)
+		self._poll_interval = poll_interval
+		self._wake = threading.Event()
+		self._stop = threading.Event()
+		self._log = logging.getLogger('PortfolioService')
+
+	def load(self):
+		db_session = get_db_session()
+		try:
+			for portfolio in self._portfolios.values():
+				portfolio.load(db_session)
+		finally:
+			db_session.close()
+
+	def portfolio(self, name):
+		if name not in self._portfolios:
+			raise KeyError('Unknown portfolio "%s"' %(name))
+		return self._portfolios[name]
+
+	def request_refresh(self):
+		self._wake.set()
+
+	def refresh(self):
+		db_session = get_db_session()
+		try:
+			for name, portfolio in self._portfolios.items():
+				num_new = portfolio.refresh(db_session)
+				if num_new > 0:
+					self._log.info('Absorbed %d new or changed transactions into "%s"' %(num_new, name))
+		finally:
+			db_session.close()
+
+	def run_refresher(self):
+		# Polling is the fallback, a notification or /refresh wakes it early
+		while not self._stop.is_set():
+			self._wake.wait(self._poll_interval)
+			self._wake.clear()
+			if self._stop.is_set():
+				return
+			try:
+				self.refresh()
+			except Exception as e:
+				self._log.exception('Refresh failed: %s' %(str(e)))
+
+	def stop(self):
+		self._stop.set()
+		self._wake.set()
+
+def printable(value):
+	if isinstance(value, dict):
+		return dict((printable_key(k), printable(v)) for k, v in value.items())
+	if isinstance(value, (list, tuple)):
+		return [printable(v) for v in value]
+	if isinstance(value, Decimal):
+		return float(value)
+	if isinstance(value, enum.Enum):
+		return printable_key(value)
+	if isinstance(value, datetime.datetime):
+		return value.isoformat()
+	return value
+
+def printable_key(key):
+	if isinstance(key, enum.Enum):
+		if type(key).__name__ == 'Currency':
+			return CURRENCIES[key.value]
+		return key.name
+	return key
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+	service = None
+
+	def address_string(self):
+		# Unix socket peers have no address
+		return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+	def log_message(self, format, *args):
+		# Through logging rather than stderr, so -Q and -J apply
+		logging.getLogger('PortfolioService').debug('%s %s' %(self.address_string(), format % args))
+
+	def log_error(self, format, *args):
+		logging.getLogger('PortfolioService').warning('%s %s' %(self.address_string(), format % args))
+
+	def send_json(self, code, body):
+		data = json.dumps(printable(body), sort_keys=True).encode('utf8')
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+		try:
+			if url.path == '/portfolios':
+				self.send_json(200, sorted(self.service._portfolios.keys()))
+			elif url.path == '/report':
+				breakdowns = [b.split(',') for b in parse_qs(url.query).get('breakdown', [])]
+				self.send_json(200, self.service.portfolio(params['name']).report(
+					breakdowns = breakdowns,
+					mark = params.get('mark') == '1'))
+			elif url.path == '/holdings':
+				self.send_json(200, self.service.portfolio(params['name']).holdings())
+			elif url.path == '/harvest':
+				# Only the currencies priced in the query are considered
+				prices = dict()
+				for price in parse_qs(url.query).get('price', []):
+					currency, value = price.split(':')
+					prices[Currency[currency]] = Decimal(value)
+				self.send_json(200, self.service.portfolio(params['name']).harvest(prices, Decimal(params['target'])))
+			elif url.path == '/aging':
+				self.send_json(200, self.service.portfolio(params['name']).aging(int(params.get('days', 30))))
+			else:
+				self.send_json(404, {'error': 'Unknown path "%s"' %(url.path)})
+		except KeyError as e:
+			self.send_json(400, {'error': str(e)})
+		except Exception as e:
+			logging.getLogger('PortfolioService').exception('Request failed')
+			self.send_json(500, {'error': str(e)})
+
+	def do_POST(self):
+		if urlparse(self.path).path == '/refresh':
+			self.service.request_refresh()
+			self.send_json(202, {'refresh': 'requested'})
+		else:
+			self.send_json(404, {'error': 'Unknown path "%s"' %(self.path)})
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+	daemon_threads = True
+
+def make_server(service, port=None, socket_path=None):
+	handler = type('BoundServiceRequestHandler', (ServiceRequestHandler,), {'service': service})
+	if socket_path is not None:
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+		return UnixHTTPServer(socket_path, handler)
+	return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+if __name__ == '__main__':
+
+	import optparse
+	parser = optparse.OptionParser(
+		usage='usage: %prog [options]',
+		version='%prog 1.0')
+	parser.add_option('-L', '--log-level',
+		default = 'INFO',
+		help = 'log level {DEBUG, INFO, WARNING, ERROR, CRITICAL}. [%default]')
+	parser.add_option('-J', '--log-json',
+		action='store_true',
+		default=False,
+		help='Log JSON Lines instead of text')
+	parser.add_option('-Q', '--log-queue',
+		action='store_true',
+		default=False,
+		help='Hand log records to a background thread so callers never wait on log I/O')
+	parser.add_option('-t', '--type',
+		type=str,
+		action='append',
+		default=[],
+		help='Name of an account type to serve, repeatable {business, personal}')
+	parser.add_option('-p', '--port',
+		type=int,
+		default=8765,
+		help='Local port to serve on. [%default]')
+	parser.add_option('-s', '--socket',
+		type=str,
+		help='Serve on this Unix socket instead of a port')
+	parser.add_option('-i', '--poll-interval',
+		type=float,
+		default=30.0,
+		help='Seconds between polls for newly ingested transactions. [%default]')
+	parser.add_option('-n', '--listen',
+		action='store_true',
+		default=False,
+		help='Also wake on Postgres NOTIFY %s' %(NOTIFY_CHANNEL))
+	(opts, args) = parser.parse_args()
+
+	from util import log_setup
+	log_setup.setupLogging(opts.log_level, json_lines=opts.log_json, queued=opts.log_queue)
+	log = logging.getLogger('main')
+
+	service = PortfolioService(opts.type, opts.poll_interval)
+	service.load()
+	threading.Thread(target=service.run_refresher, name='refresher', daemon=True).start()
+	if opts.listen:
+		listener = PgNotifyListener(service._wake)
+		threading.Thread(target=listener.run, name='listener', daemon=True).start()
+	server = make_server(service, port=opts.port, socket_path=opts.socket)
+	log.info('Serving %s on %s' %(', '.join(opts.type), opts.socket or '127.0.0.1:%d' %(opts.port)))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		service.stop()
+		server.server_close()
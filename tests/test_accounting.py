@@ -0,0 +1,43 @@
+import datetime
+from decimal import Decimal
+import unittest
+
+from accounting import Portfolio
+from models import Account, Currency
+from records import TransactionRecord
+
+def buy(transaction_id, time, qty, price):
+	return TransactionRecord(
+		transaction_id,
+		Account.CoinbasePro,
+		Currency.USD,
+		qty * price,
+		Account.CoinbasePro,
+		Currency.BTC,
+		qty,
+		qty * price,
+		Decimal(0),
+		time)
+
+class SetLotMethodTest(unittest.TestCase):
+	def make_portfolio(self, lot_method):
+		portfolio = Portfolio('business', datetime.datetime(2019, 1, 1), lot_method)
+		time = datetime.datetime(2019, 1, 1)
+		for i in range(50):
+			time += datetime.timedelta(hours=1)
+			portfolio.process(buy(i + 1, time, Decimal(1), Decimal((i * 37) % 50 + 1)))
+		return portfolio
+
+	def lot_ids(self, portfolio):
+		return [lot._transaction_id for lot in portfolio._wallets[Currency.BTC]._open_txns]
+
+	def test_rebuilds_in_acquisition_order(self):
+		for from_method in ('fifo', 'lifo', 'hifo', 'average'):
+			for to_method in ('fifo', 'lifo', 'hifo', 'average'):
+				with self.subTest(from_method=from_method, to_method=to_method):
+					portfolio = self.make_portfolio(from_method)
+					portfolio.set_lot_method(to_method)
+					self.assertEqual(self.lot_ids(portfolio), self.lot_ids(self.make_portfolio(to_method)))
+
+if __name__ == '__main__':
+	unittest.main()
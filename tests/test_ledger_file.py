@@ -0,0 +1,79 @@
+import datetime
+from decimal import Decimal
+import os
+import random
+import tempfile
+import unittest
+
+from ledger_file import LedgerFileWriter, LedgerFile
+from models import Account, Currency
+from records import TransactionRecord
+
+class LedgerFileTest(unittest.TestCase):
+	START_TIME = datetime.datetime(2019, 1, 1)
+
+	def make_records(self, num_rows):
+		rng = random.Random(num_rows)
+		accounts = list(Account)
+		currencies = list(Currency)
+		time = LedgerFileTest.START_TIME
+		records = list()
+		for i in range(num_rows):
+			time += datetime.timedelta(minutes=rng.randint(0, 600), microseconds=rng.randint(0, 999999))
+			records.append(TransactionRecord(
+				i + 1,
+				rng.choice(accounts),
+				rng.choice(currencies),
+				Decimal(rng.randint(-10**15, 10**15)).scaleb(-12),
+				rng.choice(accounts),
+				rng.choice(currencies),
+				Decimal(rng.randint(0, 10**20)).scaleb(-12),
+				Decimal(rng.randint(0, 10**18)).scaleb(-6),
+				Decimal(rng.randint(0, 10**6)).scaleb(-4),
+				time))
+		return records
+
+	def write(self, records, end_time):
+		handle, filepath = tempfile.mkstemp(suffix='.bin')
+		os.close(handle)
+		self.addCleanup(os.remove, filepath)
+		writer = LedgerFileWriter('business', LedgerFileTest.START_TIME, end_time)
+		for record in records:
+			writer.append(record)
+		writer.write(filepath)
+		return filepath
+
+	def test_round_trip(self):
+		for num_rows in (0, 1, 5, 50, 99, 1000, 3200):
+			with self.subTest(num_rows=num_rows):
+				records = self.make_records(num_rows)
+				end_time = (records[-1].transacted_at if records else LedgerFileTest.START_TIME) + datetime.timedelta(days=1)
+				with LedgerFile(self.write(records, end_time)) as ledger:
+					self.assertEqual(len(ledger), num_rows)
+					self.assertEqual(ledger._name, 'business')
+					self.assertEqual(list(ledger.records()), records)
+
+	def test_time_range(self):
+		records = self.make_records(500)
+		end_time = records[-1].transacted_at + datetime.timedelta(days=1)
+		with LedgerFile(self.write(records, end_time)) as ledger:
+			for lo, hi in ((0, 500), (10, 20), (123, 456), (499, 500)):
+				start = records[lo].transacted_at
+				end = records[hi].transacted_at if hi < len(records) else end_time
+				self.assertEqual(list(ledger.records(start, end)), records[lo:hi])
+
+	def test_check(self):
+		records = self.make_records(100)
+		end_time = records[-1].transacted_at + datetime.timedelta(days=1)
+		with LedgerFile(self.write(records, end_time)) as ledger:
+			ledger.check('business', LedgerFileTest.START_TIME, end_time)
+			ledger.check('business', records[10].transacted_at, records[50].transacted_at)
+			with self.assertRaises(Exception):
+				ledger.check('personal', LedgerFileTest.START_TIME, end_time)
+			with self.assertRaises(Exception):
+				ledger.check('business', LedgerFileTest.START_TIME - datetime.timedelta(days=1), end_time)
+			with self.assertRaises(Exception):
+				ledger.check('business', LedgerFileTest.START_TIME, end_time + datetime.timedelta(seconds=1))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,68 @@
+import os
+import threading
+
+_registries = list()
+# Resources dropped in a forked child are kept referenced here so that
+# garbage collection never closes sockets still owned by the parent
+_orphans = list()
+
+class LazyRegistry(object):
+	def __init__(self, name):
+		self._name = name
+		self._factories = dict()
+		self._teardowns = dict()
+		self._instances = dict()
+		self._lock = threading.RLock()
+		self._pid = os.getpid()
+		_registries.append(self)
+
+	def register(self, key, factory, teardown=None):
+		with self._lock:
+			self._factories[key] = factory
+			self._teardowns[key] = teardown
+
+	def get(self, key):
+		if self._pid != os.getpid():
+			self._after_fork()
+		instance = self._instances.get(key)
+		if instance is not None:
+			return instance
+		with self._lock:
+			# Another thread may have created it while we waited
+			instance = self._instances.get(key)
+			if instance is None:
+				if key not in self._factories:
+					raise Exception('Nothing registered as "%s" in registry "%s"' %(key, self._name))
+				instance = self._factories[key]()
+				self._instances[key] = instance
+			return instance
+
+	def is_created(self, key):
+		return key in self._instances
+
+	def reset(self, key=None):
+		with self._lock:
+			keys = list(self._instances.keys()) if key is None else [key]
+			for k in keys:
+				instance = self._instances.pop(k, None)
+				teardown = self._teardowns.get(k)
+				if instance is not None and teardown is not None:
+					teardown(instance)
+
+	def _after_fork(self):
+		# Never tear down in the child, the parent still owns the resources
+		_orphans.extend(self._instances.values())
+		self._instances = dict()
+		self._lock = threading.RLock()
+		self._pid = os.getpid()
+
+def reset_all():
+	for registry in _registries:
+		registry.reset()
+
+def _reset_after_fork():
+	for registry in _registries:
+		registry._after_fork()
+
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,4 +1,16 @@
+import atexit
+import copy
+import datetime
+import json
 import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Attributes every LogRecord has, anything else came in through extra=
+# (rate_limit only steers RateLimitFilter)
+STANDARD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__.keys()) | set(['message', 'asctime', 'rate_limit'])
 
 class CustomFormatter(logging.Formatter):
 	def __init__(self,
@@ -17,20 +29,105 @@ class CustomFormatter(logging.Formatter):
 		record.shortlevel = record.levelname[:3]
 		return super(CustomFormatter, self).format(record)
 
+class JsonLinesFormatter(logging.Formatter):
+	# One JSON object per line, extra= fields become top level keys
+	def format(self, record):
+		line = {
+			'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+			'level': record.levelname,
+			'logger': record.name,
+			'file': record.filename,
+			'line': record.lineno,
+			'func': record.funcName,
+			'thread': record.threadName,
+			'process': record.process,
+			'message': record.getMessage()
+		}
+		if record.exc_info:
+			line['exc_info'] = self.formatException(record.exc_info)
+		elif record.exc_text:
+			line['exc_info'] = record.exc_text
+		for key, value in record.__dict__.items():
+			if key not in STANDARD_ATTRIBUTES and key not in line:
+				line[key] = value
+		return json.dumps(line, default=str, sort_keys=True)
+
+class RateLimitFilter(logging.Filter):
+	# Passes at most burst records per interval from each call site that logs
+	# with extra={'rate_limit': True}, e.g. once per API page. The next record
+	# let through carries how many were dropped in between.
+	def __init__(self, burst=10, interval=60.0):
+		super(RateLimitFilter, self).__init__()
+		self._burst = burst
+		self._interval = interval
+		self._lock = threading.Lock()
+		self._windows = dict()
+
+	def filter(self, record):
+		if not getattr(record, 'rate_limit', False):
+			return True
+		key = (record.name, record.pathname, record.lineno)
+		now = time.monotonic()
+		with self._lock:
+			window_start, count, suppressed = self._windows.get(key, (now, 0, 0))
+			if now - window_start >= self._interval:
+				window_start, count = now, 0
+			if count >= self._burst:
+				self._windows[key] = (window_start, count, suppressed + 1)
+				return False
+			self._windows[key] = (window_start, count + 1, 0)
+		if suppressed > 0:
+			record.suppressed = suppressed
+		return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+	# The caller only merges the message args and enqueues, layout and stream
+	# I/O happen on the listener thread
+	def prepare(self, record):
+		record = copy.copy(record)
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info:
+			# Formatters print exc_text, the traceback objects stay behind
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		return record
+
 def setupLogging(
 	log_level,
 	add_manager_time = True,
-	add_pid = True):
+	add_pid = True,
+	json_lines = False,
+	queued = False,
+	rate_limit_burst = 10,
+	rate_limit_interval = 60.0):
 	level = log_level #logging._levelNames.get(log_level.upper())
 	logStreamHandler = logging.StreamHandler()
 	logStreamHandler.setLevel(level)
-	format = '%(asctime)s %(manager_time)s%(pid)5s%(shortlevel)s %(filename)s:%(lineno)d %(name)s:%(funcName)s %(message)s'
-	formatter = CustomFormatter(
-		format = format,
-		add_manager_time = add_manager_time,
-		add_pid = add_pid)
+	if json_lines:
+		formatter = JsonLinesFormatter()
+	else:
+		format = '%(asctime)s %(manager_time)s%(pid)5s%(shortlevel)s %(filename)s:%(lineno)d %(name)s:%(funcName)s %(message)s'
+		formatter = CustomFormatter(
+			format = format,
+			add_manager_time = add_manager_time,
+			add_pid = add_pid)
 	logStreamHandler.setFormatter(formatter)
-	logging.getLogger().addHandler(logStreamHandler)
+	rateLimitFilter = RateLimitFilter(rate_limit_burst, rate_limit_interval)
+	if queued:
+		# Logging threads only put on an unbounded queue, a listener thread
+		# does the formatting and stream I/O
+		logQueue = queue.SimpleQueue()
+		queueHandler = NonBlockingQueueHandler(logQueue)
+		queueHandler.setLevel(level)
+		queueHandler.addFilter(rateLimitFilter)
+		listener = logging.handlers.QueueListener(logQueue, logStreamHandler, respect_handler_level=True)
+		listener.start()
+		atexit.register(listener.stop)
+		logging.getLogger().addHandler(queueHandler)
+	else:
+		logStreamHandler.addFilter(rateLimitFilter)
+		logging.getLogger().addHandler(logStreamHandler)
 	logging.getLogger().setLevel(level)
 
 def setLogLevel(log_level):
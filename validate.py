@@ -0,0 +1,146 @@
+from collections import defaultdict
+from decimal import Decimal
+import logging
+
+from database import get_db_session
+from models import Transaction, Account, Currency, CURRENCIES
+from sqlalchemy import select
+
+COLUMNS = ('id', 'from_account', 'from_currency', 'from_amount', 'to_account', 'to_currency', 'to_amount', 'transacted_at')
+
+class LedgerValidator(object):
+	# Finds everything VirtualWallet.process would raise on over a ledger
+	# range before any lot matching starts: same currency trades, rows no
+	# wallet can take, zero amounts the unit price divides by and sells
+	# that overdraw a wallet. Rows are classified column by column and
+	# balances are running sums of each currency's signed flows starting
+	# from the snapshot, so every problem is reported in one pass.
+	def __init__(self, portfolio):
+		self._portfolio = portfolio
+		self._log = logging.getLogger('LedgerValidator')
+
+	def opening_balances(self):
+		return dict(
+			(currency, wallet._open_txns.cost_totals()[0])
+		for currency, wallet in self._portfolio._wallets.items())
+
+	@staticmethod
+	def fetch_columns(filters, batch_size=10000):
+		db_session = get_db_session()
+		try:
+			statement = select(*[getattr(Transaction, column) for column in COLUMNS])\
+				.where(*filters)\
+				.order_by(Transaction.transacted_at.asc())
+			result = db_session.execute(
+				statement,
+				execution_options = {'stream_results': True})
+			rows = list()
+			for partition in result.partitions(batch_size):
+				rows += partition
+		finally:
+			db_session.close()
+		return LedgerValidator.to_columns(rows)
+
+	@staticmethod
+	def to_columns(rows):
+		columns = dict((column, list()) for column in COLUMNS)
+		for row in rows:
+			for column in COLUMNS:
+				columns[column].append(getattr(row, column))
+		return columns
+
+	def validate(self, columns):
+		problems = list()
+		ids = columns['id']
+		times = columns['transacted_at']
+		from_accounts = columns['from_account']
+		to_accounts = columns['to_account']
+		from_currencies = columns['from_currency']
+		to_currencies = columns['to_currency']
+		from_amounts = columns['from_amount']
+		to_amounts = columns['to_amount']
+		num_rows = len(ids)
+
+		def problem(kind, row, currency=None, **details):
+			problems.append(dict(details,
+				problem = kind,
+				transaction_id = ids[row],
+				transacted_at = times[row],
+				currency = currency))
+
+		same_account = [from_accounts[i] == to_accounts[i] for i in range(num_rows)]
+		from_external = [account == Account.External for account in from_accounts]
+		to_external = [account == Account.External for account in to_accounts]
+		same_currency = [from_currencies[i] == to_currencies[i] and not (from_external[i] or to_external[i])
+			for i in range(num_rows)]
+		for row in (i for i in range(num_rows) if same_currency[i]):
+			problem('same_currency', row, from_currencies[row])
+
+		# Each wallet sees a row as a buy of to_currency or else a sell of
+		# from_currency, exactly as VirtualWallet.process decides
+		flow_rows = defaultdict(list)
+		flows = defaultdict(list)
+		for row in range(num_rows):
+			if same_currency[row]:
+				continue
+			for currency in set((from_currencies[row], to_currencies[row])):
+				if currency == Currency.USD:
+					continue
+				if to_currencies[row] == currency and (same_account[row] or from_external[row]):
+					qty = to_amounts[row]
+				elif from_currencies[row] == currency and (same_account[row] or to_external[row]):
+					qty = -from_amounts[row]
+				else:
+					problem('unsupported_accounts', row, currency,
+						from_account = from_accounts[row],
+						to_account = to_accounts[row])
+					continue
+				if qty == 0:
+					problem('zero_amount', row, currency)
+					continue
+				flow_rows[currency].append(row)
+				flows[currency].append(qty)
+
+		opening = self.opening_balances()
+		for currency, qtys in flows.items():
+			balance = opening.get(currency, Decimal(0.0))
+			rows = flow_rows[currency]
+			for i in range(len(qtys)):
+				if balance + qtys[i] < 0:
+					# Left out as if rejected, so an overdraw neither hides nor
+					# invents others further on
+					problem('insufficient_balance', rows[i], currency,
+						qty = -qtys[i],
+						balance = balance,
+						shortfall = -(balance + qtys[i]))
+					continue
+				balance += qtys[i]
+		problems.sort(key=lambda problem: (problem['transacted_at'], problem['transaction_id']))
+		self._log.info('Validated %d transactions, found %d problems' %(num_rows, len(problems)))
+		return problems
+
+	def validate_range(self, end_time, ledger=None):
+		# Same rows CapFifoQueue would process from the portfolio to end_time
+		start_time = self._portfolio._time
+		if ledger is not None:
+			ledger.check(self._portfolio._name, start_time, end_time)
+			return self.validate(LedgerValidator.to_columns(ledger.records(start_time, end_time)))
+		from accounting import CapFifoQueue
+		return self.validate(LedgerValidator.fetch_columns(
+			CapFifoQueue.portfolio_filters(self._portfolio._name) + [
+				Transaction.transacted_at >= start_time,
+				Transaction.transacted_at < end_time]))
+
+	@staticmethod
+	def format_problems(problems):
+		lines = list()
+		for problem in problems:
+			details = ', '.join('%s=%s' %(key, problem[key]) for key in sorted(problem.keys())
+				if key not in ('problem', 'transaction_id', 'transacted_at', 'currency'))
+			lines.append('%s transaction_id=%d at %s %s%s' %(
+				problem['problem'],
+				problem['transaction_id'],
+				problem['transacted_at'].isoformat(),
+				CURRENCIES[problem['currency'].value] if problem['currency'] is not None else '',
+				(' ' + details) if details else ''))
+		return '\n'.join(lines)